@@ -79,6 +79,24 @@ def create_app():
         app.register_blueprint(audio.audio_bp)
         app.register_blueprint(cwd.cwd_bp)
         from app.utils.assets_util import compile_static_assets
+        from app.utils.ann_index import ANNIndex
+        from app.utils.bm25_index import BM25Index
+        from app.utils.pdf_util import PDFExtractionPool
+        from app.modules.embedding.embedding_util import PreprocessingPool, TextSplitter
+        from app.utils.query_embedding_cache import QueryEmbeddingCache
+        from app.utils.rate_limiter import RateLimitScheduler
+        from app.utils.vector_cache import VectorCache
+        from app.utils.vector_store import VectorStore
+
+        VectorCache.configure(app.config)
+        VectorStore.configure(app.config)
+        ANNIndex.configure(app.config)
+        QueryEmbeddingCache.configure(app.config)
+        BM25Index.configure(app.config)
+        PDFExtractionPool.configure(app.config)
+        TextSplitter.configure(app.config)
+        PreprocessingPool.configure(app.config)
+        RateLimitScheduler.configure(app.config)
 
         compile_static_assets(assets)
 
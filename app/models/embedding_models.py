@@ -22,6 +22,7 @@ class Document(db.Model, SoftDeleteMixin, TimestampMixin):
     total_tokens = db.Column(db.Integer, nullable=False)
     pages = db.Column(db.String(25), nullable=True)
     selected = db.Column(db.Boolean, default=False)
+    centroid = db.Column(db.LargeBinary, nullable=True)  # Normalised mean of the chunk embeddings, float32
     chunks = db.relationship(
         "DocumentChunk",
         back_populates="document",
@@ -41,6 +42,8 @@ class DocumentChunk(db.Model):
     content = db.Column(db.Text, nullable=False)
     tokens = db.Column(db.Integer, nullable=False)
     pages = db.Column(db.String(25), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # sha256 of the normalised content
+    embedded = db.Column(db.Boolean, default=False, nullable=False)  # Checkpoint for resuming embedding tasks
     document = db.relationship("Document", back_populates="chunks")
     embedding = db.relationship(
         "DocumentEmbedding",
@@ -51,6 +51,8 @@ class EmbeddingTask(db.Model):
     chunk_size = db.Column(db.Integer)
     temp_path = db.Column(db.String(255))
     advanced_preprocessing = db.Column(db.Boolean, default=False)
+    stage = db.Column(db.String(20), default="pending", nullable=False)  # pending, splitting, embedding, complete, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # Deliveries so far, redeliveries included
 
     def __repr__(self):
         return f"<EmbeddingTask {self.id} - {self.title}>"
@@ -13,6 +13,7 @@ from app import bcrypt, mail, login_manager, db
 from sqlalchemy import or_
 from datetime import datetime, timedelta
 
+from app.utils.rate_limiter import RateLimitScheduler
 from app.utils.vector_cache import VectorCache
 
 auth_bp = Blueprint("auth_bp", __name__, template_folder="templates", static_folder="static", url_prefix="/auth")
@@ -58,6 +59,7 @@ def login():
                     user.last_attempt_time = None
                     db.session.commit()
                     login_user(user, remember=remember)
+                    VectorCache.prewarm(user.id)
                     return jsonify({"status": "success", "redirect": url_for("user_bp.dashboard")})
                 else:
                     return jsonify({"status": "unconfirmed", "redirect": url_for("auth_bp.confirm_email")})
@@ -199,8 +201,8 @@ def confirm_email():
 @auth_bp.route("/logout")
 @login_required
 def logout():
+    VectorCache.clear_cache(current_user.id)
     logout_user()
-    VectorCache.clear_cache()
     return redirect(url_for(".login"))
 
 
@@ -213,6 +215,16 @@ def get_api_keys():
     return jsonify(decrypted_api_keys)
 
 
+@auth_bp.route("/rate_limits", methods=["GET"])
+@login_required
+def get_rate_limits():
+    # What this web worker has queued and learnt for the selected key; Celery workers log their own
+    key_id = current_user.selected_api_key_id
+    if key_id is None:
+        return jsonify({"error": "No API key selected"}), 404
+    return jsonify({"queue_depth": RateLimitScheduler.queue_depth(key_id), "limits": RateLimitScheduler.stats(key_id)})
+
+
 @auth_bp.route("/reset_password_request", methods=["GET", "POST"])
 def reset_password_request():
     s = URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
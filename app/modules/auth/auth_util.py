@@ -11,6 +11,7 @@ from cryptography.fernet import Fernet
 from flask_login import current_user
 from app import db
 from app.models.user_models import UserAPIKey, User
+from app.utils.rate_limiter import BACKGROUND, INTERACTIVE, RateLimitScheduler
 
 
 def generate_confirmation_code():
@@ -164,7 +165,8 @@ def initialize_openai_client(user_id):
         return None, "API Key not found."
 
     api_key = decrypt_api_key(user_api_key.encrypted_api_key)
-    client = OpenAI(api_key=api_key, max_retries=5, timeout=30.0)
+    client = OpenAI(api_key=api_key, max_retries=5, timeout=30.0,
+                    http_client=RateLimitScheduler.http_client(key_id, INTERACTIVE, timeout=30.0))
     return client, None
 
 
@@ -175,7 +177,8 @@ def task_client(session, user_id, max_retries=3, timeout=15):
     if not user_api_key:
         return None, "API Key not found."
     api_key = decrypt_api_key(user_api_key.encrypted_api_key)
-    client = OpenAI(api_key=api_key, max_retries=max_retries, timeout=timeout)
+    client = OpenAI(api_key=api_key, max_retries=max_retries, timeout=timeout,
+                    http_client=RateLimitScheduler.http_client(key_id, BACKGROUND, timeout=timeout))
     return client, key_id, None
 
 def task_async_client(session, user_id):
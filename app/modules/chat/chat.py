@@ -84,7 +84,7 @@ def chat_index():
         for doc in user_documents
     ]
     if preferences.knowledge_query_mode:
-        VectorCache.load_user_vectors(current_user.id)
+        VectorCache.prewarm(current_user.id)
     return render_template(
         "chat_page.html",
         new_conversation_form=new_conversation_form,
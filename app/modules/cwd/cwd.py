@@ -40,7 +40,7 @@ def cwd_index():
         db.session.commit()
 
     preferences_dict = model_to_dict(preferences)
-    VectorCache.load_user_vectors(current_user.id)
+    VectorCache.prewarm(current_user.id)
     return render_template(
         "cwd.html", documents=documents_data, doc_preferences_form=UpdateDocPreferencesForm(data=preferences_dict)
     )
@@ -1,42 +1,22 @@
-from typing import List
-
-import numpy as np
 import openai
-import tiktoken
 from flask_login import current_user
 from openai import RateLimitError
 from app import db, socketio
 from app.models.chat_models import ChatPreferences
-from app.models.embedding_models import DocumentChunk, Document, ModelContextWindow
-from app.utils.vector_cache import VectorCache
+from app.modules.embedding.embedding_util import get_query_embedding, hydrate_chunks, search_chunks
 from app.utils.logging_util import configure_logging
 
 logger = configure_logging()
 
-def find_relevant_sections(user_id, query_embedding, user_preferences):
+def find_relevant_sections(user_id, query_embedding, user_preferences, query_text=None):
     context_window_size = 120000
     max_sections = user_preferences.top_k
     threshold = user_preferences.threshold
 
-    document_chunks_with_details = (
-        db.session.query(
-            DocumentChunk.id,
-            Document.title,
-            Document.author,
-            DocumentChunk.pages,
-            DocumentChunk.content,  # Include the chunk content
-            DocumentChunk.tokens,
-        )
-        .join(Document)
-        .filter(Document.user_id == user_id, Document.selected == 1)
-        .all()
-    )
-
-    # Get the IDs of the chunks for the current user's documents
-    subset_ids = [str(chunk.id) for chunk in document_chunks_with_details]
-
-    # Get a descending list of similarities for the subset using the MIPS naive method
-    similarities = VectorCache.mips_naive(query_embedding, subset_ids)
+    # Only the best max_sections chunks can be selected, so rank just those on ids alone
+    top_chunks = search_chunks(user_id, query_embedding, max_sections, query_text)
+    chunks_by_id = hydrate_chunks(user_id, top_chunks)
+    similarities = [(chunk_id, rank) for rank, chunk_id in enumerate(top_chunks, start=1)]
 
     # Filter out any similarities below the threshold
     filtered_similarities = [(chunk_id, sim) for chunk_id, sim in similarities if sim >= threshold]
@@ -50,7 +30,7 @@ def find_relevant_sections(user_id, query_embedding, user_preferences):
         if sections_appended >= max_sections:
             break
 
-        chunk = next((c for c in document_chunks_with_details if str(c.id) == chunk_id), None)
+        chunk = chunks_by_id.get(chunk_id)
         if chunk and current_tokens + chunk.tokens <= context_window_size:
             selected_chunks.append(
                 (chunk.id, chunk.title, chunk.author, chunk.pages, chunk.content, chunk.tokens, similarity)
@@ -63,20 +43,13 @@ def find_relevant_sections(user_id, query_embedding, user_preferences):
     return selected_chunks
 
 
-def get_embedding(text: str, client: openai.OpenAI, model="text-embedding-3-large", **kwargs) -> List[float]:
-    response = client.embeddings.create(input=text, model=model, **kwargs)
-    embedding = response.data[0].embedding
-    if len(embedding) != 3072:
-        raise ValueError(f"Expected embedding dimension to be 3072, but got {len(embedding)}")
-    return embedding
-
-
 def append_knowledge_context(user_query, user_id, client):
-    query_embedding = get_embedding(user_query, client)
-    query_vector = np.array(query_embedding, dtype=np.float32)
+    query_vector = get_query_embedding(user_query, client)
     user_preferences = db.session.query(ChatPreferences).filter_by(user_id=user_id).one()
 
-    relevant_sections = find_relevant_sections(user_id, query_vector, user_preferences=user_preferences)
+    relevant_sections = find_relevant_sections(
+        user_id, query_vector, user_preferences=user_preferences, query_text=user_query
+    )
     context = ""
     chunk_associations = []
     doc_pages = {}  # Dictionary to hold document ID and a list of pages
@@ -199,6 +199,7 @@ def update_document_selection():
 
     document.selected = selected
     db.session.commit()
+    VectorCache.save_selection(current_user.id)
 
     return jsonify({"status": "success"})
 
@@ -243,7 +244,7 @@ def update_docs_preferences():
         # Update knowledge query mode
         chat_preferences.knowledge_query_mode = "knowledge_query_mode" in form_data
         if chat_preferences.knowledge_query_mode:
-            VectorCache.load_user_vectors(current_user.id)
+            VectorCache.prewarm(current_user.id)
 
 
         chat_preferences.top_k = int(form_data.get("top_k", 0))
@@ -300,6 +301,7 @@ def update_docs_preferences():
             chat_preferences.top_p = 1.0
         try:
             db.session.commit()
+            VectorCache.save_selection(current_user.id)
             return jsonify({"status": "success", "message": "Preferences updated successfully."})
         except Exception as e:
             db.session.rollback()
@@ -1,11 +1,14 @@
 import concurrent
+import hashlib
 import os
 import re
-import unicodedata
+import threading
+import time
 import uuid
+from collections import deque
 from typing import List, Tuple, Set, Generator
 
-from nltk.data import find
+from nltk.data import find, load
 from flask_login import current_user
 
 from app.modules.user.user_util import get_user_upload_directory
@@ -20,14 +23,26 @@ from werkzeug.utils import secure_filename
 from app import db
 from app.models.embedding_models import ModelContextWindow, Document, DocumentChunk, DocumentEmbedding
 from app.models.chat_models import ChatPreferences
-from app.utils.vector_cache import VectorCache
+from app.models.mixins import generate_uuid
+from app.utils.bm25_index import BM25Index, reciprocal_rank_fusion
+from app.utils.pdf_util import PDFExtractionPool
+from app.utils.query_embedding_cache import QueryEmbeddingCache, normalize_text
+from app.utils.vector_cache import VectorCache, normalize_rows
+from app.utils.vector_store import VectorStore
 from app.utils.logging_util import configure_logging
 
 logger = configure_logging()
 ENCODING = tiktoken.get_encoding("cl100k_base")
 EMBEDDING_MODEL = "text-embedding-3-large"
 MAX_TOKENS_PER_BATCH = 8000  # Define the maximum tokens per batch
+MAX_INPUTS_PER_BATCH = 2048  # The embeddings endpoint takes at most 2048 inputs per request
+EMBEDDING_BATCH_WORKERS = 4  # Concurrent embeddings requests per document
+STORE_FLUSH_ROWS = 1024  # Embedded rows collected before each vector store append
+HASH_LOOKUP_BATCH = 500  # Content hashes per IN (...) query
 WORDS_PER_PAGE = 500  # Define the number of words per page
+PAGES_PER_ENCODE = 8  # Pages tokenised per encode_batch call by the token-offset splitter
+DEFAULT_PREPROCESS_WORKERS = 8  # GPT preprocessing requests in flight per process
+PREPROCESS_LOOKAHEAD = 2  # Chunks per preprocessing worker a splitter may have outstanding
 
 
 def download_nltk_data():
@@ -86,32 +101,81 @@ def gpt_preprocess(text, client):
     return response
 
 
+def preprocess_or_raw(text, client) -> str:
+    """The GPT-cleaned chunk, or the chunk as it was when preprocessing fails."""
+    try:
+        cleaned = gpt_preprocess(text, client).content
+    except Exception as e:
+        logger.error(f"An error occurred during preprocessing, keeping the raw chunk: {e}")
+        return text
+    return cleaned or text
+
+
+class PreprocessingPool:
+    """Thread pool for GPT preprocessing requests, shared by every TextSplitter in the process.
+
+    It lives as long as the process, so documents don't pay for a fresh pool per batch, and
+    its size bounds the preprocessing requests in flight no matter how many documents are split.
+    """
+
+    _executor = None
+    _lock = threading.Lock()
+    workers = DEFAULT_PREPROCESS_WORKERS
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls.workers = int(config.get("GPT_PREPROCESS_WORKERS", DEFAULT_PREPROCESS_WORKERS))
+
+    @classmethod
+    def submit(cls, text, client) -> futures.Future:
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = futures.ThreadPoolExecutor(max_workers=cls.workers, thread_name_prefix="preprocess")
+            return cls._executor.submit(preprocess_or_raw, text, client)
+
+
 def get_embedding(text: str, client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> List[float]:
     response = client.embeddings.create(input=text, model=model, **kwargs)
     embedding = response.data[0].embedding
-    if len(embedding) != 3072:
-        raise ValueError(f"Expected embedding dimension to be 3072, but got {len(embedding)}")
+    expected_dimensions = kwargs.get("dimensions", 3072)
+    if len(embedding) != expected_dimensions:
+        raise ValueError(f"Expected embedding dimension to be {expected_dimensions}, but got {len(embedding)}")
+    return embedding
+
+
+def get_query_embedding(text: str, client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> np.ndarray:
+    """get_embedding for search queries, served from QueryEmbeddingCache when the text was seen recently."""
+    key = QueryEmbeddingCache.key(text, model, kwargs.get("dimensions", 3072))
+    embedding = QueryEmbeddingCache.get(key)
+    if embedding is None:
+        embedding = QueryEmbeddingCache.put(key, get_embedding(text, client, model, **kwargs))
     return embedding
 
 
 def get_embedding_batch(texts: List[str], client: openai.OpenAI, model=EMBEDDING_MODEL, **kwargs) -> List[List[float]]:
-    embeddings = []
+    batches = []
     current_batch = []
     current_tokens = 0
 
-    # Function to process a single batch of texts concurrently
+    # One embeddings request per batch, with the results put back in input order
     def process_batch(batch):
-        # This uses a list comprehension to process all texts in the batch concurrently
-        # through the `get_embedding` function.
-        return [get_embedding(text, client, model, **kwargs) for text in batch]
-
-    # Collect texts into batches based on token limits
+        response = client.embeddings.create(input=batch, model=model, **kwargs)
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        expected_dimensions = kwargs.get("dimensions", 3072)
+        if len(embeddings) != len(batch):
+            raise ValueError(f"Expected {len(batch)} embeddings, but got {len(embeddings)}")
+        for embedding in embeddings:
+            if len(embedding) != expected_dimensions:
+                raise ValueError(f"Expected embedding dimension to be {expected_dimensions}, but got {len(embedding)}")
+        return embeddings
+
+    # Collect texts into batches based on token and input count limits
     for text in texts:
         text = text.replace("\n", " ")
         token_estimate = count_tokens(text)
-        if current_tokens + token_estimate > MAX_TOKENS_PER_BATCH:
+        if current_tokens + token_estimate > MAX_TOKENS_PER_BATCH or len(current_batch) >= MAX_INPUTS_PER_BATCH:
             if current_batch:  # Ensure there is something to process
-                embeddings.append(current_batch)  # Prepare batch for processing
+                batches.append(current_batch)  # Prepare batch for processing
             current_batch = [text]  # Start a new batch
             current_tokens = token_estimate
         else:
@@ -119,65 +183,340 @@ def get_embedding_batch(texts: List[str], client: openai.OpenAI, model=EMBEDDING
             current_tokens += token_estimate
 
     if current_batch:  # Check if there's a last batch to process
-        embeddings.append(current_batch)  # Prepare last batch for processing
+        batches.append(current_batch)  # Prepare last batch for processing
 
-    # Process all batches concurrently and flatten the result
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Map each batch to the executor for concurrent processing
-        results = list(executor.map(process_batch, embeddings))
-        # Flatten the list of lists to a single list of embeddings
-        final_embeddings = [item for sublist in results for item in sublist]
+    if len(batches) == 1:
+        return process_batch(batches[0])
 
-    return final_embeddings
+    # Process the batches concurrently and flatten the result
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EMBEDDING_BATCH_WORKERS) as executor:
+        results = list(executor.map(process_batch, batches))
+    return [item for sublist in results for item in sublist]
 
 
 
-def store_embeddings(session, document_id, embeddings, user_id):
-    chunks = session.query(DocumentChunk).filter_by(document_id=document_id).all()
-    if len(chunks) != len(embeddings):
-        raise ValueError("The number of embeddings does not match the number of document chunks.")
+class EmbeddingDeadlineExceeded(Exception):
+    """Raised between batches once an EmbeddingPipeline runs past its deadline."""
 
-    embedding_models = []
-    for chunk, embedding_vector in zip(chunks, embeddings):
-        embedding_bytes = np.array(embedding_vector, dtype=np.float32).tobytes()
-        embedding_model = DocumentEmbedding(
-            chunk_id=chunk.id, embedding=embedding_bytes, user_id=user_id, model=EMBEDDING_MODEL  # Store as binary data
-        )
-        embedding_models.append(embedding_model)
 
-    session.bulk_save_objects(embedding_models)
-    session.commit()
+def content_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
 
 
+def find_existing_embeddings(session, user_id, hashes, model=EMBEDDING_MODEL, dimensions=3072) -> dict:
+    """Returns content_hash -> embedding for chunks this user has already embedded with the model."""
+    hashes = list(hashes)
+    found = {}
+    for start in range(0, len(hashes), HASH_LOOKUP_BATCH):
+        rows = (
+            session.query(DocumentChunk.content_hash, DocumentEmbedding.embedding)
+            .join(DocumentEmbedding, DocumentEmbedding.chunk_id == DocumentChunk.id)
+            .filter(
+                DocumentEmbedding.user_id == user_id,
+                DocumentEmbedding.model == model,
+                DocumentChunk.content_hash.in_(hashes[start:start + HASH_LOOKUP_BATCH]),
+            )
+            .all()
+        )
+        for chunk_hash, embedding in rows:
+            if len(embedding) == dimensions * 4:
+                found[chunk_hash] = np.frombuffer(embedding, dtype=np.float32).tolist()
+    return found
+
+
+class EmbeddingPipeline:
+    """Embeds and stores a document's chunks as they come out of the splitter.
+
+    Chunks are grouped into batches within the embeddings request limits. Each full batch is
+    inserted, then embedded on a small thread pool while the caller keeps extracting and
+    splitting. Once max_in_flight requests are outstanding, add() stores the oldest batch
+    before it returns, which keeps memory bounded however long the document is. Chunks whose
+    content this user already embedded reuse the stored vector instead of being sent again.
+
+    Chunk ids are generated here, so chunks and embeddings go in as plain executemany inserts
+    without the ORM: each embedded batch is one chunk insert and one embedding insert, and every
+    STORE_FLUSH_ROWS rows are committed together just before their vectors and BM25 postings are
+    written out, so no more than that much text is ever held. The committed chunks are always a
+    prefix of the document, so a task that dies part way can resume() after them and split the
+    rest again; a failed embeddings request commits what was stored before it. checkpoint()
+    stores the chunks still waiting on embeddings once splitting is done, so a resume needn't
+    split at all.
+
+    With a deadline (a time.monotonic() value), the first batch dispatched after it has passed
+    stores the requests already in flight and raises EmbeddingDeadlineExceeded, leaving
+    everything committed so far for the next attempt.
+    """
+
+    def __init__(self, session, user_id, document_id, client, model=EMBEDDING_MODEL,
+                 max_in_flight=EMBEDDING_BATCH_WORKERS, deadline=None, **kwargs):
+        self.session = session
+        self.user_id = user_id
+        self.document_id = document_id
+        self.client = client
+        self.model = model
+        self.kwargs = kwargs
+        self.dimensions = kwargs.get("dimensions", 3072)
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self.in_flight = []  # (chunks, known embeddings, hashes sent, tokens sent, future), oldest first
+        self.checkpointed = set()  # Ids of chunks already stored as waiting, updated rather than inserted
+        self.batch = []
+        self.batch_tokens = 0
+        self.unflushed = []  # (chunk_ids, vectors, texts) committed but not yet in the vector store
+        self.postings_parts = 0  # BM25 postings files written for this document
+        self.centroid_sum = None
+        self.chunk_count = 0
+        self.total_tokens = 0
+        self.embedded_tokens = 0  # Tokens sent to the API and committed by this attempt
+        self.uncommitted_tokens = 0
+        self.reused_chunks = 0
+
+    def add(self, content: str, pages, tokens: int) -> None:
+        self._queue({
+            "id": generate_uuid(),
+            "document_id": self.document_id,
+            "chunk_index": self.chunk_count,
+            "content": content,
+            "tokens": tokens,
+            "pages": ",".join(map(str, sorted(pages))) if pages is not None else None,
+            "content_hash": content_hash(content),
+        })
+        self.chunk_count += 1
+        self.total_tokens += tokens
+
+    def _queue(self, chunk: dict) -> None:
+        if self.batch and (self.batch_tokens + chunk["tokens"] > MAX_TOKENS_PER_BATCH
+                           or len(self.batch) >= MAX_INPUTS_PER_BATCH):
+            self.dispatch()
+        self.batch.append(chunk)
+        self.batch_tokens += chunk["tokens"]
+
+    def dispatch(self) -> None:
+        """Sends whatever the pending batch needs embedded."""
+        self._check_deadline()
+        chunks, self.batch, self.batch_tokens = self.batch, [], 0
+        if not chunks:
+            return
+
+        known = find_existing_embeddings(self.session, self.user_id, {chunk["content_hash"] for chunk in chunks},
+                                         self.model, self.dimensions)
+        misses = {}
+        for chunk in chunks:
+            if chunk["content_hash"] not in known:
+                misses.setdefault(chunk["content_hash"], chunk)
+        self.reused_chunks += len(chunks) - len(misses)
+        future = None
+        if misses:
+            future = self.executor.submit(get_embedding_batch, [chunk["content"] for chunk in misses.values()],
+                                          self.client, self.model, **self.kwargs)
+
+        # Backpressure: never more than max_in_flight requests outstanding
+        while len(self.in_flight) >= self.max_in_flight:
+            self._store(*self.in_flight.pop(0))
+        self.in_flight.append((chunks, known, list(misses), sum(chunk["tokens"] for chunk in misses.values()), future))
+
+    def checkpoint(self) -> None:
+        """Dispatches the pending batch and stores every chunk still waiting on its embeddings as split."""
+        self.dispatch()
+        waiting = [chunk for chunks, *_ in self.in_flight for chunk in chunks if chunk["id"] not in self.checkpointed]
+        if waiting:
+            self.session.execute(DocumentChunk.__table__.insert(), [dict(chunk, embedded=False) for chunk in waiting])
+            self._commit()
+            self.checkpointed.update(chunk["id"] for chunk in waiting)
+
+    def _check_deadline(self) -> None:
+        if self.deadline is None or time.monotonic() <= self.deadline:
+            return
+        # Requests already sent are paid for, so their results are stored before stopping
+        while self.in_flight:
+            self._store(*self.in_flight.pop(0))
+        self._flush()
+        raise EmbeddingDeadlineExceeded(f"Embedding ran past its deadline after {self.chunk_count} chunks")
+
+    def _store(self, chunks, known, sent_hashes, sent_tokens, future) -> None:
+        if future is not None:
+            try:
+                known.update(zip(sent_hashes, future.result()))
+            except Exception:
+                self._flush()  # The batches stored before this one are paid for; keep them
+                raise
+        vectors = np.array([known[chunk["content_hash"]] for chunk in chunks], dtype=np.float32)
+        chunk_ids = [chunk["id"] for chunk in chunks]
+        new_chunks = [dict(chunk, embedded=True) for chunk in chunks if chunk["id"] not in self.checkpointed]
+        if new_chunks:
+            self.session.execute(DocumentChunk.__table__.insert(), new_chunks)
+        if len(new_chunks) < len(chunks):
+            waiting = [chunk_id for chunk_id in chunk_ids if chunk_id in self.checkpointed]
+            self.session.execute(
+                DocumentChunk.__table__.update().where(DocumentChunk.id.in_(waiting)).values(embedded=True)
+            )
+            self.checkpointed.difference_update(waiting)
+        self.session.execute(DocumentEmbedding.__table__.insert(), [
+            {"id": generate_uuid(), "chunk_id": chunk_id, "user_id": self.user_id,
+             "embedding": vector.tobytes(), "model": self.model}
+            for chunk_id, vector in zip(chunk_ids, vectors)
+        ])
+        self.uncommitted_tokens += sent_tokens
+
+        chunk_sum = normalize_rows(vectors).sum(axis=0)
+        self.centroid_sum = chunk_sum if self.centroid_sum is None else self.centroid_sum + chunk_sum
+        self.unflushed.append((chunk_ids, vectors, [chunk["content"] for chunk in chunks]))
+        if sum(len(ids) for ids, _, _ in self.unflushed) >= STORE_FLUSH_ROWS:
+            self._flush()
+
+    def _commit(self) -> None:
+        self.session.commit()
+        self.embedded_tokens += self.uncommitted_tokens
+        self.uncommitted_tokens = 0
+
+    def _flush(self) -> None:
+        # Few, larger segments and postings files: every flush writes one of each
+        if not self.unflushed:
+            return
+        self._commit()
+        ids = [chunk_id for chunk_ids, _, _ in self.unflushed for chunk_id in chunk_ids]
+        VectorCache.add_vectors(self.user_id, ids, np.concatenate([vectors for _, vectors, _ in self.unflushed]),
+                                [self.document_id] * len(ids))
+        self._write_postings(ids, [text for _, _, texts in self.unflushed for text in texts])
+        self.unflushed = []
+
+    def _write_postings(self, chunk_ids: list, texts: list) -> None:
+        BM25Index.add_document(self.user_id, self.document_id, chunk_ids, texts, part=self.postings_parts)
+        self.postings_parts += 1
+
+    def resume(self) -> int:
+        """Picks up the chunks an earlier attempt stored and returns how many there were.
+
+        Embedded chunks missing from the vector store (committed but not yet flushed when the
+        attempt died) are added to it, the document's BM25 postings are rewritten from the
+        embedded chunks, and checkpointed chunks that were never embedded are queued. Chunk text
+        is read STORE_FLUSH_ROWS rows at a time.
+        """
+        chunks = (
+            self.session.query(DocumentChunk.id, DocumentChunk.tokens, DocumentChunk.embedded)
+            .filter_by(document_id=self.document_id)
+            .order_by(DocumentChunk.chunk_index)
+            .all()
+        )
+        if not chunks:
+            return 0  # A new document; nothing to reconcile
+        self.chunk_count = len(chunks)
+        self.total_tokens = sum(chunk.tokens for chunk in chunks)
+
+        stored_ids = {chunk_id.decode() for chunk_id in VectorStore(self.user_id).chunk_ids()}
+        BM25Index.remove_document(self.user_id, self.document_id)  # Parts may be missing or stale
+        embedded_ids = [chunk.id for chunk in chunks if chunk.embedded]
+        for start in range(0, len(embedded_ids), STORE_FLUSH_ROWS):
+            rows = (
+                self.session.query(DocumentEmbedding.chunk_id, DocumentEmbedding.embedding, DocumentChunk.content)
+                .join(DocumentChunk, DocumentChunk.id == DocumentEmbedding.chunk_id)
+                .filter(DocumentEmbedding.chunk_id.in_(embedded_ids[start:start + STORE_FLUSH_ROWS]))
+                .order_by(DocumentChunk.chunk_index)
+                .all()
+            )
+            vectors = np.array([np.frombuffer(row.embedding, dtype=np.float32) for row in rows])
+            chunk_sum = normalize_rows(vectors).sum(axis=0)
+            self.centroid_sum = chunk_sum if self.centroid_sum is None else self.centroid_sum + chunk_sum
+            missing = [i for i, row in enumerate(rows) if row.chunk_id not in stored_ids]
+            if missing:
+                VectorCache.add_vectors(self.user_id, [rows[i].chunk_id for i in missing], vectors[missing],
+                                        [self.document_id] * len(missing))
+            self._write_postings([row.chunk_id for row in rows], [row.content for row in rows])
+
+        pending_ids = [chunk.id for chunk in chunks if not chunk.embedded]
+        self.checkpointed.update(pending_ids)
+        for start in range(0, len(pending_ids), STORE_FLUSH_ROWS):
+            pending = (
+                self.session.query(DocumentChunk.id, DocumentChunk.content, DocumentChunk.tokens,
+                                   DocumentChunk.content_hash)
+                .filter(DocumentChunk.id.in_(pending_ids[start:start + STORE_FLUSH_ROWS]))
+                .order_by(DocumentChunk.chunk_index)
+                .all()
+            )
+            for chunk in pending:
+                self._queue({"id": chunk.id, "content": chunk.content, "tokens": chunk.tokens,
+                             "content_hash": chunk.content_hash or content_hash(chunk.content)})
+        self.dispatch()
+        return len(chunks)
+
+    def finish(self) -> None:
+        """Embeds and stores whatever is still pending, then writes the per-document summaries."""
+        try:
+            self.dispatch()
+            while self.in_flight:
+                self._store(*self.in_flight.pop(0))
+            self._flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+        centroid = normalize_rows(self.centroid_sum).tobytes() if self.centroid_sum is not None else None
+        self.session.query(Document).filter_by(id=self.document_id).update(
+            {"total_tokens": self.total_tokens, "centroid": centroid}
+        )
+        self.session.commit()
+        if not self.postings_parts:
+            self._write_postings([], [])  # So searches don't take an empty document for one to backfill
 
-def find_relevant_sections(user_id, query_embedding, user_preferences):
-    # Fetch the context window size
-    context_window_size = (
-        db.session.query(ModelContextWindow.context_window_size).filter_by(model_name=user_preferences.model).scalar()
-    )
+    def stop(self) -> None:
+        """Cancels outstanding requests; what was already committed stays for the next attempt."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
-    max_sections = user_preferences.top_k
 
-    # Fetch the document chunks and additional details for the user
-    document_chunks_with_details = (
+def search_chunks(user_id, query_vector, top_k, query_text=None):
+    """Returns the ids of the top_k chunks of the user's selected documents for a query, best first.
+
+    With hybrid search enabled and the query text available, dense and BM25 keyword rankings
+    are merged with reciprocal-rank fusion so exact identifiers and rare names are not missed.
+    The ranking is then diversified (MMR and near-duplicate removal) if that is configured.
+    """
+    pool = VectorCache.candidate_count(top_k)
+    if not BM25Index.enabled or not query_text:
+        ranked = [chunk_id for chunk_id, _ in VectorCache.search(user_id, query_vector, pool, selected_only=True)]
+    else:
+        candidates = pool * BM25Index.candidate_factor
+        dense = VectorCache.search(user_id, query_vector, candidates, selected_only=True)
+        _, selected_document_ids = VectorCache.selected_documents(user_id)
+        keyword = BM25Index.search(user_id, query_text, candidates,
+                                   [document_id.decode() for document_id in selected_document_ids])
+        ranked = reciprocal_rank_fusion([[chunk_id for chunk_id, _ in dense], [chunk_id for chunk_id, _ in keyword]],
+                                        BM25Index.rrf_k)[:pool]
+    return VectorCache.diversify(user_id, ranked, top_k)
+
+
+def hydrate_chunks(user_id, chunk_ids) -> dict:
+    """Fetches the details of just the given chunks in one query, keyed by chunk id."""
+    if not chunk_ids:
+        return {}
+    chunks = (
         db.session.query(
             DocumentChunk.id,
             Document.title,
             Document.author,
             DocumentChunk.pages,
-            DocumentChunk.content,  # Include the chunk content
+            DocumentChunk.content,
             DocumentChunk.tokens,
         )
         .join(Document)
-        .filter(Document.user_id == user_id, Document.selected == 1)
+        .filter(Document.user_id == user_id, DocumentChunk.id.in_(chunk_ids))
         .all()
     )
+    return {str(chunk.id): chunk for chunk in chunks}
 
-    # Get the IDs of the chunks for the current user's documents
-    subset_ids = [str(chunk.id) for chunk in document_chunks_with_details]
 
-    # Get a descending list of similarities for the subset using the MIPS naive method
-    similarities = VectorCache.mips_naive(query_embedding, subset_ids)
+
+def find_relevant_sections(user_id, query_embedding, user_preferences, query_text=None):
+    # Fetch the context window size
+    context_window_size = (
+        db.session.query(ModelContextWindow.context_window_size).filter_by(model_name=user_preferences.model).scalar()
+    )
+
+    max_sections = user_preferences.top_k
+
+    # Only the best max_sections chunks can be selected, so rank just those on ids alone
+    top_chunks = search_chunks(user_id, query_embedding, max_sections, query_text)
+    chunks_by_id = hydrate_chunks(user_id, top_chunks)
+    similarities = [(chunk_id, rank) for rank, chunk_id in enumerate(top_chunks, start=1)]
 
     # Select chunks based on the max number of sections and token limit
     selected_chunks = []
@@ -188,7 +527,7 @@ def find_relevant_sections(user_id, query_embedding, user_preferences):
         if sections_appended >= max_sections:
             break
 
-        chunk = next((c for c in document_chunks_with_details if str(c.id) == chunk_id), None)
+        chunk = chunks_by_id.get(chunk_id)
         if chunk and current_tokens + chunk.tokens <= context_window_size:
             selected_chunks.append(
                 (chunk.id, chunk.title, chunk.author, chunk.pages, chunk.content, chunk.tokens, similarity)
@@ -207,11 +546,10 @@ def append_knowledge_context(user_query, user_id, client):
         return user_query
 
     # Embed the user query
-    query_embedding = get_embedding(user_query, client)
-    query_vector = np.array(query_embedding, dtype=np.float32)
+    query_vector = get_query_embedding(user_query, client)
 
     # Find relevant sections
-    relevant_sections = find_relevant_sections(user_id, query_vector, user_preferences)
+    relevant_sections = find_relevant_sections(user_id, query_vector, user_preferences, query_text=user_query)
     context = ""
     chunk_associations = []
 
@@ -259,6 +597,12 @@ class TextExtractor:
     def extract_text_from_pdf(self):
         with open(self.filepath, "rb") as file:
             reader = PdfReader(file)
+            page_count = len(reader.pages)
+            if PDFExtractionPool.enabled_for(page_count):
+                # Large PDFs are split into page ranges and extracted on the process pool
+                yield from PDFExtractionPool.extract(self.filepath, page_count)
+                self.last_page_number = page_count
+                return
             for page_number, page in enumerate(reader.pages, start=1):
                 page_text = page.extract_text()
                 if page_text:
@@ -288,24 +632,45 @@ class TextExtractor:
         return self.last_page_number
 
 class TextSplitter:
-    def __init__(self, max_tokens: int = 512, client=None, use_gpt_preprocessing=False, filepath=None):
+    token_offsets = False  # Split by token offsets instead of re-encoding sentences and words
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls.token_offsets = bool(config.get("TEXT_SPLITTER_TOKEN_OFFSETS", False))
+
+    def __init__(self, max_tokens: int = 512, client=None, use_gpt_preprocessing=False, filepath=None,
+                 token_offsets=None, skip_chunks: int = 0):
         self.max_tokens = max_tokens
-        self.batch_size = 4000 // max_tokens
         self.filepath = filepath
-        self.temp_chunks = []
         self.use_gpt_preprocessing = use_gpt_preprocessing
         self.client = client
+        self.preprocessing = deque()  # Futures of chunks being preprocessed, in chunk order
+        self.max_preprocessing = PreprocessingPool.workers * PREPROCESS_LOOKAHEAD
+        self.chunks_appended = 0
+        self.skip_chunks = skip_chunks  # Already stored by an earlier attempt, so not worth preprocessing
         self.chunks = []
         self.chunk_pages = []
+        self.chunk_tokens = []  # Exact counts of self.chunks, when the token engine produced them
         self.current_chunk = []
         self.current_chunk_token_count = 0
         self.current_chunk_pages = set()
+        if token_offsets is not None:
+            self.token_offsets = token_offsets
+        self.pending_pages = []
         download_nltk_data()
+        if self.token_offsets:
+            self.sentence_tokenizer = load("tokenizers/punkt/english.pickle")
 
     def add_text(self, text: str, page_number: int = None):
         ext = os.path.splitext(self.filepath)[1].lower()
         if ext not in [".py", ".html", ".css", ".js", "md", "yml", "json"]:
             text = preprocess_text(text)
+        if self.token_offsets:
+            # Pages are encoded a few at a time; encode_batch spreads them over tiktoken's threads
+            self.pending_pages.append((text, page_number))
+            if len(self.pending_pages) >= PAGES_PER_ENCODE:
+                self._encode_pending_pages()
+            return
         sentences = sent_tokenize(text)
 
         for sentence in sentences:
@@ -327,13 +692,13 @@ class TextSplitter:
                 current_sentence_chunk.append(word)
                 self.current_chunk_token_count += word_token_count
             else:
-                self.chunks.append(" ".join(current_sentence_chunk))
+                self._append_chunk(" ".join(current_sentence_chunk))
                 self.chunk_pages.append(self.current_chunk_pages.copy() if page_number is not None else None)
                 current_sentence_chunk = [word]
                 self.current_chunk_token_count = word_token_count
                 self.current_chunk_pages = {page_number} if page_number is not None else set()
         if current_sentence_chunk:
-            self.chunks.append(" ".join(current_sentence_chunk))
+            self._append_chunk(" ".join(current_sentence_chunk))
             self.chunk_pages.append(self.current_chunk_pages.copy() if page_number is not None else None)
         self.current_chunk = []
         self.current_chunk_token_count = 0
@@ -345,47 +710,133 @@ class TextSplitter:
         if page_number is not None:
             self.current_chunk_pages.add(page_number)
 
-    def _finalize_current_chunk(self, page_number: int = None, force_process: bool = False):
+    def _finalize_current_chunk(self, page_number: int = None):
         if self.current_chunk:
             final_chunk = " ".join(self.current_chunk)
-            if self.use_gpt_preprocessing and self.client is not None:
-                self.temp_chunks.append(final_chunk)
-                if len(self.temp_chunks) >= self.batch_size or force_process:
-                    self._process_all_chunks()
-            else:
-                self.chunks.append(final_chunk)
+            self._append_chunk(final_chunk)
             self.chunk_pages.append(self.current_chunk_pages.copy() if page_number is not None else None)
             self.current_chunk = []
             self.current_chunk_token_count = 0
             self.current_chunk_pages = set()
-    def _process_all_chunks(self):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            processed_chunks = list(executor.map(self._process_chunk, self.temp_chunks))
-        self.chunks.extend(processed_chunks)
-        self.temp_chunks = []
 
-    def _process_chunk(self, chunk):
+    def _append_chunk(self, final_chunk: str, tokens: int = None):
+        if final_chunk:
+            self.chunks_appended += 1  # Counted like split() yields them, so skip_chunks lines up
         if self.use_gpt_preprocessing and self.client is not None:
-            try:
-                response = gpt_preprocess(chunk, self.client)
-                return response.content
-            except Exception as e:
-                logger.error(f"An error occurred during preprocessing: {e}")
-                return None
+            if not final_chunk or self.chunks_appended <= self.skip_chunks:
+                future = futures.Future()
+                future.set_result(final_chunk)
+            else:
+                future = PreprocessingPool.submit(final_chunk, self.client)
+            self.preprocessing.append(future)
+            self._collect_preprocessed(wait_for=self.max_preprocessing)
+        else:
+            self.chunks.append(final_chunk)
+            if tokens is not None:
+                self.chunk_tokens.append(tokens)
+
+    def _collect_preprocessed(self, wait_for: int = 0):
+        # Finished chunks move to self.chunks in order; this only blocks while more than
+        # wait_for are outstanding, so splitting carries on while requests are in flight
+        while self.preprocessing and (len(self.preprocessing) > wait_for or self.preprocessing[0].done()):
+            self.chunks.append(self.preprocessing.popleft().result())
+
+    def _encode_pending_pages(self):
+        # Sentences are cut by character span and carry the whitespace before them, so one
+        # encode_batch call tokenises every character of these pages exactly once
+        pages, self.pending_pages = self.pending_pages, []
+        pieces, piece_pages = [], []
+        for text, page_number in pages:
+            previous_end = 0
+            for _, end in self.sentence_tokenizer.span_tokenize(text):
+                pieces.append((" " if previous_end == 0 else "") + text[previous_end:end])
+                piece_pages.append(page_number)
+                previous_end = end
+        encoded = ENCODING.encode_batch(pieces, disallowed_special=())
+        for piece, tokens, page_number in zip(pieces, encoded, piece_pages):
+            self._add_sentence_tokens(piece, tokens, page_number)
+
+    def _add_sentence_tokens(self, sentence: str, tokens: List[int], page_number: int):
+        if len(tokens) > self.max_tokens:
+            self._finalize_token_chunk()
+            self._process_long_token_sentence(sentence.lstrip(), page_number)
+            return
+        if self.current_chunk_token_count + len(tokens) > self.max_tokens:
+            self._finalize_token_chunk()
+        if not self.current_chunk and sentence[:1].isspace():
+            tokens = ENCODING.encode(sentence.lstrip(), disallowed_special=())  # Chunks don't start with a space
+        self._add_tokens_to_current_chunk(tokens, page_number)
+
+    def _process_long_token_sentence(self, sentence: str, page_number: int):
+        # Cut into max_tokens windows, backing off to a word boundary in the window's second half
+        tokens = ENCODING.encode(sentence, disallowed_special=())
+        decoded, offsets = ENCODING.decode_with_offsets(tokens)
+        start = 0
+        while len(tokens) - start > self.max_tokens:
+            cut = start + self.max_tokens
+            for boundary in range(cut, start + self.max_tokens // 2, -1):
+                if decoded[offsets[boundary]:offsets[boundary] + 1].isspace():
+                    cut = boundary
+                    break
+            self._add_tokens_to_current_chunk(tokens[start:cut], page_number)
+            self._finalize_token_chunk()
+            start = cut
+        self._add_tokens_to_current_chunk(tokens[start:], page_number)
+
+    def _add_tokens_to_current_chunk(self, tokens: List[int], page_number: int):
+        self.current_chunk.append(tokens)
+        self.current_chunk_token_count += len(tokens)
+        if page_number is not None:
+            self.current_chunk_pages.add(page_number)
+
+    def _finalize_token_chunk(self):
+        if self.current_chunk:
+            tokens = [token for part in self.current_chunk for token in part]
+            final_chunk = ENCODING.decode(tokens)
+            token_count = len(tokens)
+            if final_chunk != final_chunk.strip():
+                final_chunk = final_chunk.strip()  # Only after a long sentence was cut before a space
+                token_count = count_tokens(final_chunk)
+            if final_chunk:
+                self._append_chunk(final_chunk, token_count)
+                self.chunk_pages.append(self.current_chunk_pages.copy() if self.current_chunk_pages else None)
+            self.current_chunk = []
+            self.current_chunk_token_count = 0
+            self.current_chunk_pages = set()
+
+    def _finish(self):
+        if self.token_offsets:
+            self._encode_pending_pages()
+            self._finalize_token_chunk()
         else:
-            return chunk
-    def _process_batch(self, batch: List[str], client: openai.OpenAI) -> Generator[str, None, None]:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(gpt_preprocess, text, client) for text in batch]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    yield future.result().content
-                except Exception as e:
-                    logger.error(f"An error occurred during preprocessing: {e}")
-                    yield None
+            self._finalize_current_chunk()
+        self._collect_preprocessed()
+
+    def split(self, text_pages) -> Generator[Tuple[str, Set[int], int], None, None]:
+        """Yields (chunk, pages, tokens) for each chunk as soon as it is complete, so the caller can
+        embed earlier chunks while later pages are still being extracted."""
+        try:
+            for text, page_number in text_pages:
+                self.add_text(text, page_number)
+                yield from self._drain()
+            self._finish()
+            yield from self._drain()
+        finally:
+            for future in self.preprocessing:
+                future.cancel()  # The caller gave up; don't spend requests on chunks nobody will read
+
+    def _drain(self) -> Generator[Tuple[str, Set[int], int], None, None]:
+        self._collect_preprocessed(wait_for=len(self.preprocessing))
+        ready = min(len(self.chunks), len(self.chunk_pages))
+        for i, (chunk, pages) in enumerate(zip(self.chunks[:ready], self.chunk_pages[:ready])):
+            if chunk:
+                yield chunk, pages, self.chunk_tokens[i] if self.chunk_tokens else count_tokens(chunk)
+        del self.chunks[:ready]
+        del self.chunk_pages[:ready]
+        del self.chunk_tokens[:ready]
 
     def finalize(self) -> Tuple[List[str], List[Set[int]], int, List[int]]:
-        self._finalize_current_chunk(force_process=True)
-        chunk_token_counts = [count_tokens(chunk) for chunk in self.chunks]
+        self._finish()
+        chunk_token_counts = self.chunk_tokens or [count_tokens(chunk) for chunk in self.chunks]
         total_tokens = sum(chunk_token_counts)
         return self.chunks, self.chunk_pages, total_tokens, chunk_token_counts
\ No newline at end of file
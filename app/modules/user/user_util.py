@@ -33,3 +33,9 @@ def get_user_audio_directory(user_id):
     directory = os.path.join(USER_DIRECTORY, str(user_id), "audio_files")
     ensure_directory_exists(directory)
     return directory
+
+
+def get_user_vector_directory(user_id):
+    directory = os.path.join(USER_DIRECTORY, str(user_id), "vectors")
+    ensure_directory_exists(directory)
+    return directory
@@ -3,15 +3,25 @@ from datetime import datetime, timedelta
 from glob import glob
 
 from app.models.audio_models import TTSJob, TranslationJob, TranscriptionJob
-from app.models.embedding_models import Document
+from sqlalchemy import bindparam
+
+from app.models.embedding_models import Document, DocumentChunk
 from app.models.task_models import Task, EmbeddingTask
+from app.modules.embedding.embedding_util import content_hash
 from app.modules.user.user_util import get_user_audio_directory
 from app.tasks.celery_task import celery
+from app.tasks.embedding_task import compact_vector_store, STAGE_SPLITTING, STAGE_EMBEDDING
 from app.utils.logging_util import configure_logging
+from app.utils.query_embedding_cache import QueryEmbeddingCache
 from app.utils.task_util import make_session
+from app.utils.vector_store import VectorStore
 
 logger = configure_logging()
 
+RESUMABLE_STAGES = (STAGE_SPLITTING, STAGE_EMBEDDING)
+CONTENT_HASH_BATCH_ROWS = 1000  # Chunks hashed and committed at a time
+CONTENT_HASH_MAX_ROWS = 100000  # Per run; the schedule picks up where it stopped
+
 
 @celery.task()
 def cleanup_documents():
@@ -28,6 +38,8 @@ def cleanup_documents():
         for document in all_documents:
             document_task_id = document.task_id
             embedding_task = session.query(EmbeddingTask).filter_by(task_id=document_task_id).first()
+            if embedding_task and embedding_task.stage in RESUMABLE_STAGES and not document.delete:
+                continue  # Still being embedded; a resumed attempt needs the upload
             if embedding_task and os.path.exists(embedding_task.temp_path):
                 os.remove(embedding_task.temp_path)
                 logger.info(f"Removed file at {embedding_task.temp_path}")
@@ -140,3 +152,65 @@ def cleanup_translation():
         return False
     finally:
         session.remove()  # Dispose of the session correctly
+
+
+@celery.task()
+def compact_vector_stores():
+    session = make_session()
+    try:
+        user_ids = [user_id for (user_id,) in session.query(Document.user_id).distinct()]
+        for user_id in user_ids:
+            if VectorStore(user_id).needs_compaction():
+                compact_vector_store.apply_async(kwargs={"user_id": user_id})
+        return True
+    except Exception as e:
+        logger.error(f"Error scheduling vector store compaction: {e}")
+        return False
+    finally:
+        session.remove()
+
+
+@celery.task()
+def cleanup_query_embeddings():
+    try:
+        removed = QueryEmbeddingCache.prune()
+        logger.info(f"Removed {removed} expired query embeddings")
+        return True
+    except Exception as e:
+        logger.error(f"Error pruning query embeddings: {e}")
+        return False
+
+
+@celery.task()
+def backfill_content_hashes():
+    # Chunks embedded before content_hash existed can't be matched by find_existing_embeddings
+    session = make_session()
+    try:
+        statement = (
+            DocumentChunk.__table__.update()
+            .where(DocumentChunk.id == bindparam("chunk_id"))
+            .values(content_hash=bindparam("hash"))
+        )
+        hashed = 0
+        while hashed < CONTENT_HASH_MAX_ROWS:
+            chunks = (
+                session.query(DocumentChunk.id, DocumentChunk.content)
+                .filter(DocumentChunk.content_hash.is_(None))
+                .limit(CONTENT_HASH_BATCH_ROWS)
+                .all()
+            )
+            if not chunks:
+                break
+            session.execute(statement, [{"chunk_id": chunk_id, "hash": content_hash(content)}
+                                        for chunk_id, content in chunks])
+            session.commit()
+            hashed += len(chunks)
+        if hashed:
+            logger.info(f"Backfilled content hashes for {hashed} chunks")
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error backfilling content hashes: {e}")
+        return False
+    finally:
+        session.remove()
@@ -2,14 +2,16 @@ import os
 from app.tasks.celery_task import celery
 from app.models.audio_models import TranslationJob, TTSJob, TranscriptionJob
 from app.models.chat_models import Conversation
-from app.models.embedding_models import Document
+from app.models.embedding_models import Document, DocumentChunk
 from app.models.image_models import GeneratedImage, MessageImages
 from app.models.task_models import Task, DeletionTask
 from app.models.user_models import UserAPIKey, User
 from app.modules.user.user_util import get_user_gen_img_directory, get_user_chat_img_directory, \
     get_user_audio_directory, get_user_upload_directory
 from app.utils.logging_util import configure_logging
+from app.utils.bm25_index import BM25Index
 from app.utils.task_util import make_session
+from app.utils.vector_cache import VectorCache
 
 logger = configure_logging()
 
@@ -59,9 +61,16 @@ def delete_entity(session, entity_type, entity_id, user_id):
         raise ValueError(f"Entity of type '{entity_type}' with ID '{entity_id}' not found")
 
     try:
+        chunk_ids = []
+        if entity_type == "documents":
+            chunk_ids = [chunk_id for (chunk_id,) in session.query(DocumentChunk.id).filter_by(document_id=entity_id)]
         delete_local_files(entity_id, entity_type, user_id)
         session.delete(entity)
         session.commit()
+        # Tombstone the document's vectors so every process drops them without a reload
+        VectorCache.remove_ids(user_id, chunk_ids)
+        if entity_type == "documents":
+            BM25Index.remove_document(user_id, entity_id)
     except Exception as e:
         raise e
 
@@ -1,21 +1,47 @@
 import os
+import time
+
+import openai
+from celery.exceptions import SoftTimeLimitExceeded
+
 from app.models.embedding_models import Document, DocumentChunk
 from app.models.task_models import Task, EmbeddingTask
 from app.modules.auth.auth_util import task_client
 from app.modules.embedding.embedding_util import (
-    get_embedding_batch,
-    store_embeddings, TextSplitter, TextExtractor, extract_uuid_from_path,
+    EmbeddingDeadlineExceeded, EmbeddingPipeline, TextSplitter, TextExtractor, extract_uuid_from_path,
 )
 from app.utils.logging_util import configure_logging
 from app.utils.task_util import make_session
 from app.utils.usage_util import embedding_cost
+from app.utils.ann_index import update_ann_index
+from app.utils.bm25_index import BM25Index
+from app.utils.rate_limiter import RateLimitScheduler
+from app.utils.vector_cache import VectorCache
+from app.utils.vector_store import VectorStore
 from app import socketio
 from app.tasks.celery_task import celery
 
 logger = configure_logging()
 
+STAGE_PENDING = "pending"
+STAGE_SPLITTING = "splitting"  # Chunks are stored as their embeddings come back
+STAGE_EMBEDDING = "embedding"  # Every chunk is stored; only embedding remains
+STAGE_COMPLETE = "complete"
+STAGE_FAILED = "failed"
+MAX_RESUMES = 5
+MAX_ATTEMPTS = MAX_RESUMES + 1  # Deliveries of any kind, including redeliveries after a worker died
+RESUME_BACKOFF_SECONDS = 5
+# The eventlet pool doesn't enforce soft_time_limit, so the pipeline stops itself before the hard limit
+ATTEMPT_DEADLINE_SECONDS = 170
+# Failures worth resuming from the checkpoint rather than throwing the document away
+RESUMABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, SoftTimeLimitExceeded,
+                    EmbeddingDeadlineExceeded)
+
 
 def process_document(session, embedding_task, user_id):
+    deadline = time.monotonic() + ATTEMPT_DEADLINE_SECONDS
+    pipeline = None
+    key_id = None
     try:
         socketio.emit(
             "task_progress",
@@ -23,72 +49,73 @@ def process_document(session, embedding_task, user_id):
             room=str(user_id),
             namespace="/embedding",
         )
-        logger.info(f"Processing document {embedding_task.id}: {embedding_task.title}")
-
-        extractor = TextExtractor(embedding_task.temp_path)
-        text_pages = extractor.extract_text_from_file()
+        logger.info(f"Processing document {embedding_task.id}: {embedding_task.title} ({embedding_task.stage})")
 
         client, key_id, error = task_client(session, user_id)
         if error:
             raise Exception(error)
-        text_splitter = TextSplitter(max_tokens=embedding_task.chunk_size, client=client, use_gpt_preprocessing=embedding_task.advanced_preprocessing, filepath=embedding_task.temp_path)
-        logger.info(f"Splitting text into chunks of {embedding_task.chunk_size} tokens")
-        for text, page_number in text_pages:
-            text_splitter.add_text(text, page_number)
-
-        # Finalize text splitting and get results
-        chunks, chunk_pages, total_tokens, chunk_token_counts = text_splitter.finalize()
-        file_uuid = extract_uuid_from_path(embedding_task.temp_path)
-
-        new_document = Document(
-            id=file_uuid,
-            user_id=user_id,
-            task_id=embedding_task.task_id,
-            title=embedding_task.title,
-            author=embedding_task.author,
-            total_tokens=total_tokens,
-        )
-        session.add(new_document)
-        session.flush()
 
-        # Emit progress update for processing document chunks
-        socketio.emit(
-            "task_progress",
-            {"task_id": embedding_task.task_id, "message": f"Processing document chunks for {embedding_task.title}..."},
-            room=str(user_id),
-            namespace="/embedding",
-        )
-        # Process chunks as before
-        for i, (chunk_content, pages) in enumerate(zip(chunks, chunk_pages)):
-            pages_str = None
-            if pages is not None:
-                pages_str = ",".join(map(str, pages))
-            chunk = DocumentChunk(
-                document_id=new_document.id,
-                chunk_index=i,
-                content=chunk_content,
-                tokens=chunk_token_counts[i],
-                pages=pages_str,
+        # The document row goes in first so chunks can be written as soon as they are embedded
+        document_id = extract_uuid_from_path(embedding_task.temp_path)
+        document = session.query(Document).get(document_id)
+        if document is None:
+            document = Document(
+                id=document_id,
+                user_id=user_id,
+                task_id=embedding_task.task_id,
+                title=embedding_task.title,
+                author=embedding_task.author,
+                total_tokens=0,
             )
-            session.add(chunk)
+            session.add(document)
+        if embedding_task.stage == STAGE_PENDING:
+            embedding_task.stage = STAGE_SPLITTING
         session.commit()
-        # Emit progress update
-        socketio.emit(
-            "task_progress",
-            {"task_id": embedding_task.task_id, "message": f"Generating embeddings for {embedding_task.title}..."},
-            room=str(user_id),
-            namespace="/embedding",
+
+        pipeline = EmbeddingPipeline(session, user_id, document_id, client, deadline=deadline)
+        resumed_chunks = pipeline.resume()
+        if resumed_chunks:
+            logger.info(f"Resuming {embedding_task.title} with {resumed_chunks} chunks already split")
+
+        if embedding_task.stage == STAGE_SPLITTING:
+            # Extraction, splitting and embedding run as one stream: pages are pulled only as fast as
+            # the embedding requests drain, and a bounded number of batches is in flight at any time
+            extractor = TextExtractor(embedding_task.temp_path)
+            text_splitter = TextSplitter(max_tokens=embedding_task.chunk_size, client=client, use_gpt_preprocessing=embedding_task.advanced_preprocessing, filepath=embedding_task.temp_path, skip_chunks=resumed_chunks)
+            logger.info(f"Splitting text into chunks of {embedding_task.chunk_size} tokens")
+            socketio.emit(
+                "task_progress",
+                {"task_id": embedding_task.task_id, "message": f"Generating embeddings for {embedding_task.title}..."},
+                room=str(user_id),
+                namespace="/embedding",
+            )
+            chunks = text_splitter.split(extractor.extract_text_from_file())
+            for index, (chunk_content, pages, tokens) in enumerate(chunks):
+                if index >= resumed_chunks:  # Earlier attempts already stored the ones before
+                    pipeline.add(chunk_content, pages, tokens)
+            pipeline.checkpoint()
+            document.pages = str(extractor.last_page_number) if extractor.last_page_number is not None else None
+            embedding_task.stage = STAGE_EMBEDDING
+            session.commit()
+
+        pipeline.finish()
+        embedding_task.stage = STAGE_COMPLETE
+        session.commit()
+
+        logger.info(
+            f"Reused {pipeline.reused_chunks}/{pipeline.chunk_count} embeddings for {embedding_task.title} "
+            f"({pipeline.reused_chunks / max(pipeline.chunk_count, 1):.0%} hit rate)"
         )
-        embeddings = get_embedding_batch(chunks, client)
-        store_embeddings(session, new_document.id, embeddings, user_id)
-        embedding_cost(session=session, user_id=user_id, api_key_id=key_id, input_tokens=total_tokens)
+        logger.info(f"Rate limits for API key {key_id} after {embedding_task.title}: {RateLimitScheduler.stats(key_id)}")
+        update_ann_index(user_id)
+        if VectorStore(user_id).needs_compaction():
+            compact_vector_store.apply_async(kwargs={"user_id": user_id})
         socketio.emit(
             "task_progress",
             {"task_id": embedding_task.task_id, "message": f"Calculating cost of {embedding_task.title}..."},
             room=str(user_id),
             namespace="/embedding",
         )
-        final_page_count = extractor.last_page_number
         socketio.emit(
             "task_complete",
             {
@@ -98,10 +125,11 @@ def process_document(session, embedding_task, user_id):
                 "document": {
                     "title": embedding_task.title,
                     "author": embedding_task.author,
-                    "chunk_count": len(chunks),
-                    "document_id": new_document.id,
-                    "page_amount": final_page_count,
-                    "total_tokens": total_tokens,
+                    "chunk_count": pipeline.chunk_count,
+                    "document_id": document_id,
+                    "page_amount": int(document.pages) if document.pages else None,
+                    "total_tokens": pipeline.total_tokens,
+                    "reused_chunks": pipeline.reused_chunks,
                 },
             },
             room=str(user_id),
@@ -110,43 +138,97 @@ def process_document(session, embedding_task, user_id):
 
     except Exception as e:
         logger.info(f"Error processing document {embedding_task.id}: {e}")
-        os.remove(embedding_task.temp_path)
-        # Emit error event
-        socketio.emit(
-            "task_update",
-            {"task_id": embedding_task.task_id, "status": "error", "error": str(e)},
-            room=str(user_id),
-            namespace="/embedding",
-        )
+        session.rollback()
+        if pipeline is not None:
+            pipeline.stop()
         raise e
+    finally:
+        # Bill what this attempt embedded, also when it fails or is about to be resumed. A billing
+        # error must not replace the ingest error, which decides whether the task is resumed
+        if pipeline is not None and pipeline.embedded_tokens:
+            try:
+                embedding_cost(session=session, user_id=user_id, api_key_id=key_id,
+                               input_tokens=pipeline.embedded_tokens)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error billing {pipeline.embedded_tokens} embedding tokens for {embedding_task.title}: {e}")
+
 
+def fail_document(session, embedding_task, user_id, error):
+    """Gives up on a document: removes whatever was checkpointed and tells the user."""
+    session.rollback()
+    document_id = extract_uuid_from_path(embedding_task.temp_path)
+    chunk_ids = [chunk_id for (chunk_id,) in session.query(DocumentChunk.id).filter_by(document_id=document_id)]
+    document = session.query(Document).get(document_id)
+    if document is not None:
+        session.delete(document)
+    embedding_task.stage = STAGE_FAILED
+    session.commit()
+    VectorCache.remove_ids(user_id, chunk_ids)
+    BM25Index.remove_document(user_id, document_id)
+    socketio.emit(
+        "task_update",
+        {"task_id": embedding_task.task_id, "status": "error", "error": str(error)},
+        room=str(user_id),
+        namespace="/embedding",
+    )
 
-@celery.task(time_limit=200)
-def process_embedding_task(task_id):
+
+@celery.task(bind=True, soft_time_limit=190, time_limit=200, max_retries=MAX_RESUMES, acks_late=True,
+             reject_on_worker_lost=True)
+def process_embedding_task(self, task_id):
+    # Late acks put the task back on the queue if its worker dies; like a retry, it resumes from the checkpoint
     session = make_session()
     embedding_task = None
     task = None
+    resuming = False
     try:
         logger.info(f"Retrieving embedding task with ID '{task_id}'")
         embedding_task = session.query(EmbeddingTask).filter_by(task_id=task_id).first()
 
         if not embedding_task:
             raise ValueError(f"EmbeddingTask for task ID '{task_id}' not found")
+        if embedding_task.stage in (STAGE_COMPLETE, STAGE_FAILED):
+            return embedding_task.stage == STAGE_COMPLETE  # Redelivered after it had already finished
         task = session.query(Task).filter_by(id=task_id).one()
+        # max_retries only counts self.retry; this also counts redeliveries, e.g. after an OOM kill
+        embedding_task.attempts += 1
+        session.commit()
+        if embedding_task.attempts > MAX_ATTEMPTS:
+            fail_document(session, embedding_task, task.user_id,
+                          f"Gave up on {embedding_task.title} after {MAX_ATTEMPTS} attempts")
+            return False
         process_document(session, embedding_task, user_id=task.user_id)
         # Success and completion updates are now handled within process_document
         return True
-    except Exception as e:
-        session.rollback()
+    except RESUMABLE_ERRORS as e:
+        if self.request.retries >= self.max_retries or embedding_task.attempts >= MAX_ATTEMPTS:
+            fail_document(session, embedding_task, task.user_id, e)
+            return False
+        resuming = True
+        logger.info(f"Embedding task {task_id} interrupted ({e}); resuming from its checkpoint")
         socketio.emit(
-            "task_update",
-            {"task_id": task_id, "status": "error", "error": str(e)},
+            "task_progress",
+            {"task_id": task_id, "message": f"Interrupted, resuming {embedding_task.title}..."},
             room=str(task.user_id),
             namespace="/embedding",
         )
+        raise self.retry(exc=e, countdown=RESUME_BACKOFF_SECONDS * 2 ** self.request.retries)
+    except Exception as e:
+        session.rollback()
+        if embedding_task and task:
+            fail_document(session, embedding_task, task.user_id, e)
+        elif task:
+            socketio.emit(
+                "task_update",
+                {"task_id": task_id, "status": "error", "error": str(e)},
+                room=str(task.user_id),
+                namespace="/embedding",
+            )
         return False
     finally:
-        if embedding_task:
+        # The upload is kept until the document is finished, a retry may still need it
+        if embedding_task and not resuming:
             try:
                 if os.path.exists(embedding_task.temp_path):
                     os.remove(embedding_task.temp_path)
@@ -154,3 +236,19 @@ def process_embedding_task(task_id):
                 pass
         session.remove()
 
+
+@celery.task(time_limit=120)
+def compact_vector_store(user_id):
+    session = make_session()
+    try:
+        live_document_ids = [
+            document_id for (document_id,) in session.query(Document.id).filter_by(user_id=user_id, delete=False)
+        ]
+        VectorStore(user_id).compact(live_document_ids)
+        BM25Index.prune(user_id, live_document_ids)
+        return True
+    except Exception as e:
+        logger.error(f"Error compacting vector store for user {user_id}: {e}")
+        return False
+    finally:
+        session.remove()
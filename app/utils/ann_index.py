@@ -0,0 +1,192 @@
+import json
+import os
+
+import numpy as np
+
+from app.utils.vector_store import VectorStore, ID_DTYPE
+
+DEFAULT_NPROBE = 8  # Lists probed per query; higher trades latency for recall
+DEFAULT_MIN_ROWS = 50000  # Below this an exact scan is already fast enough
+IVF_DIMS = 256  # Clustering runs on the renormalised Matryoshka prefix
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+ASSIGN_BLOCK_ROWS = 8192
+RETRAIN_GROWTH = 2.0  # Retrain once the user has this many times the rows the index was trained on
+
+
+def _prefix_block(vectors: np.ndarray, start: int, stop: int, dims: int) -> np.ndarray:
+    block = np.asarray(vectors[start:stop, :dims], dtype=np.float32)
+    return block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+
+
+class ANNIndex:
+    """Base class for per-user approximate nearest-neighbour indexes.
+
+    Implementations map each row of a user's VectorStore to a small candidate set that
+    VectorCache.search then scores exactly, and persist themselves next to the store.
+    """
+
+    kind = None
+    registry = {}
+    configured_kind = None  # VECTOR_ANN_INDEX; None disables ANN search
+    nprobe = DEFAULT_NPROBE
+    min_rows = DEFAULT_MIN_ROWS
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        ANNIndex.registry[cls.kind] = cls
+
+    @classmethod
+    def configure(cls, config) -> None:
+        kind = config.get("VECTOR_ANN_INDEX")
+        if kind is not None and kind not in cls.registry:
+            raise ValueError(f"Unsupported ANN index: {kind}")
+        ANNIndex.configured_kind = kind
+        ANNIndex.nprobe = int(config.get("VECTOR_ANN_NPROBE", DEFAULT_NPROBE))
+        ANNIndex.min_rows = int(config.get("VECTOR_ANN_MIN_ROWS", DEFAULT_MIN_ROWS))
+
+    @classmethod
+    def configured(cls):
+        return cls.registry.get(cls.configured_kind)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "ANNIndex":
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, directory: str, chunk_ids: np.ndarray, vectors: np.ndarray):
+        raise NotImplementedError
+
+    def save(self, directory: str, chunk_ids: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def extended(self, vectors: np.ndarray) -> "ANNIndex":
+        """Returns a copy of the index with rows appended, without retraining."""
+        raise NotImplementedError
+
+    def probe(self, query_vector: np.ndarray, nprobe: int) -> np.ndarray:
+        raise NotImplementedError
+
+
+class IVFIndex(ANNIndex):
+    """Inverted-file index: k-means lists over the embedding prefix, probed nearest first."""
+
+    kind = "ivf"
+
+    def __init__(self, centroids: np.ndarray, lists: np.ndarray, trained_rows: int):
+        self.centroids = centroids
+        self.lists = lists  # List number of each row, aligned with the store's rows
+        self.trained_rows = trained_rows
+        self._order = np.argsort(lists, kind="stable").astype(np.int64)
+        self._offsets = np.searchsorted(lists[self._order], np.arange(len(centroids) + 1))
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + self.lists.nbytes + self._order.nbytes
+
+    @classmethod
+    def _assign(cls, centroids: np.ndarray, vectors: np.ndarray, start: int = 0) -> np.ndarray:
+        lists = np.empty(vectors.shape[0] - start, dtype=np.int32)
+        for block_start in range(start, vectors.shape[0], ASSIGN_BLOCK_ROWS):
+            block_stop = min(block_start + ASSIGN_BLOCK_ROWS, vectors.shape[0])
+            block = _prefix_block(vectors, block_start, block_stop, centroids.shape[1])
+            lists[block_start - start:block_stop - start] = np.argmax(block @ centroids.T, axis=1)
+        return lists
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "IVFIndex":
+        rows = vectors.shape[0]
+        dims = min(IVF_DIMS, vectors.shape[1])
+        list_count = max(1, int(np.sqrt(rows)))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(rows, size=min(rows, list_count * KMEANS_SAMPLE_PER_LIST), replace=False))
+        sample = _prefix_block(vectors[sample_rows], 0, len(sample_rows), dims)
+
+        # Spherical k-means on the sample
+        centroids = sample[rng.choice(len(sample), size=list_count, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~np.bincount(assignment, minlength=list_count).astype(bool)
+            sums[empty] = centroids[empty]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+
+        return cls(centroids.astype(np.float32), cls._assign(centroids, vectors), rows)
+
+    @staticmethod
+    def _paths(directory: str) -> dict:
+        return {name: os.path.join(directory, f"ivf.{name}") for name in ("centroids.npy", "ids.npy", "lists.npy", "meta.json")}
+
+    @classmethod
+    def load(cls, directory: str, chunk_ids: np.ndarray, vectors: np.ndarray):
+        """Opens the persisted index, assigning rows appended since it was saved."""
+        paths = cls._paths(directory)
+        try:
+            centroids = np.load(paths["centroids.npy"])
+            saved_ids = np.load(paths["ids.npy"])
+            saved_lists = np.load(paths["lists.npy"])
+            with open(paths["meta.json"], "r") as file:
+                trained_rows = json.load(file)["trained_rows"]
+        except FileNotFoundError:
+            return None
+
+        saved = dict(zip(saved_ids.tolist(), saved_lists.tolist()))
+        lists = np.fromiter((saved.get(chunk_id, -1) for chunk_id in chunk_ids.tolist()), dtype=np.int32,
+                            count=len(chunk_ids))
+        missing = np.flatnonzero(lists < 0)
+        if len(missing):
+            lists[missing] = cls._assign(centroids, np.asarray(vectors[missing]))
+        return cls(centroids, lists, trained_rows)
+
+    def save(self, directory: str, chunk_ids: np.ndarray) -> None:
+        paths = self._paths(directory)
+        for name, array in (("centroids.npy", self.centroids), ("ids.npy", np.asarray(chunk_ids, dtype=ID_DTYPE)),
+                            ("lists.npy", self.lists)):
+            temp_path = f"{paths[name]}.tmp"
+            with open(temp_path, "wb") as file:
+                np.save(file, array)
+            os.replace(temp_path, paths[name])
+        temp_path = f"{paths['meta.json']}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"trained_rows": self.trained_rows}, file)
+        os.replace(temp_path, paths["meta.json"])
+
+    def extended(self, vectors: np.ndarray) -> "IVFIndex":
+        return IVFIndex(self.centroids, np.concatenate([self.lists, self._assign(self.centroids, vectors)]),
+                        self.trained_rows)
+
+    def probe(self, query_vector: np.ndarray, nprobe: int) -> np.ndarray:
+        """Returns the sorted rows of the nprobe lists nearest the query."""
+        query = query_vector[: self.centroids.shape[1]]
+        query = query / max(np.linalg.norm(query), np.finfo(np.float32).tiny)
+        centroid_scores = self.centroids @ query
+        nprobe = min(nprobe, len(centroid_scores))
+        probed = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        rows = [self._order[self._offsets[i]:self._offsets[i + 1]] for i in probed]
+        return np.sort(np.concatenate(rows))
+
+
+def update_ann_index(user_id) -> None:
+    """Brings a user's persisted ANN index up to date with their vector store.
+
+    New rows are assigned to the existing lists; the index is retrained from scratch
+    once the store has grown RETRAIN_GROWTH times past what it was trained on.
+
+    Training runs on a snapshot without holding the store lock, so appends and removals
+    carry on meanwhile; the lock is only taken to publish. Rows written in the meantime are
+    assigned to the nearest list whenever the index is next loaded.
+    """
+    index_class = ANNIndex.configured()
+    if index_class is None:
+        return
+    store = VectorStore(user_id)
+    # Segments are memmapped, so the snapshot stays readable even if a compaction unlinks them
+    vectors, chunk_ids, _, _ = store.load()
+    if len(chunk_ids) < ANNIndex.min_rows:
+        return
+    index = index_class.load(store.directory, chunk_ids, vectors)
+    if index is None or len(chunk_ids) >= index.trained_rows * RETRAIN_GROWTH:
+        index = index_class.train(vectors)
+    with store.locked():
+        index.save(store.directory, chunk_ids)
@@ -0,0 +1,240 @@
+import os
+import re
+import threading
+import uuid
+from collections import Counter, OrderedDict
+
+import numpy as np
+from sqlalchemy import or_
+
+from app.models.embedding_models import Document, DocumentChunk
+from app.models.task_models import EmbeddingTask
+from app.modules.user.user_util import get_user_vector_directory
+from app.utils.vector_store import ID_DTYPE
+
+BM25_DIRECTORY = "bm25"  # Postings files per document, beside the user's vector segments
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_RRF_K = 60  # Reciprocal-rank fusion constant from Cormack et al.
+DEFAULT_CANDIDATE_FACTOR = 4  # Candidates taken from each ranker per requested result
+DEFAULT_MAX_USERS = 64
+TOKEN_PATTERN = re.compile(r"\w+")  # Keeps code identifiers like get_embedding whole
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = DEFAULT_RRF_K) -> list:
+    """Merges several ranked id lists into one, scoring each id by sum(1 / (k + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class UserPostings:
+    """All of a user's per-document postings merged into one term-sorted inverted index."""
+
+    def __init__(self, segments: list):
+        self.document_ids = [document_id for document_id, _ in segments]
+        parts = [segment for _, segment in segments]
+        self.chunk_ids = np.concatenate([part["chunk_ids"] for part in parts]) if parts else np.empty(0, ID_DTYPE)
+        self.lengths = np.concatenate([part["lengths"] for part in parts]).astype(np.float32) if parts \
+            else np.empty(0, np.float32)
+        self.row_documents = np.repeat(np.arange(len(parts), dtype=np.int32), [len(part["lengths"]) for part in parts])
+        self.average_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+
+        if not parts:
+            self.terms = np.empty(0, dtype="U1")
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.rows = np.empty(0, dtype=np.int32)
+            self.frequencies = np.empty(0, dtype=np.float32)
+            return
+
+        # Map every document's local term ids onto one shared, sorted vocabulary
+        self.terms, inverse = np.unique(np.concatenate([part["terms"] for part in parts]), return_inverse=True)
+        posting_terms, rows, row_base, term_base = [], [], 0, 0
+        for part in parts:
+            local_terms = np.repeat(np.arange(len(part["terms"])), np.diff(part["offsets"]))
+            posting_terms.append(inverse[term_base + local_terms])
+            rows.append(part["rows"] + row_base)
+            row_base += len(part["lengths"])
+            term_base += len(part["terms"])
+        posting_terms = np.concatenate(posting_terms)
+        order = np.argsort(posting_terms, kind="stable")
+        self.rows = np.concatenate(rows)[order].astype(np.int32)
+        self.frequencies = np.concatenate([part["frequencies"] for part in parts])[order].astype(np.float32)
+        self.offsets = np.searchsorted(posting_terms[order], np.arange(len(self.terms) + 1))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(part.nbytes for part in (self.chunk_ids, self.lengths, self.row_documents, self.terms,
+                                            self.offsets, self.rows, self.frequencies))
+
+    def scores(self, query_terms: list) -> np.ndarray:
+        """BM25 score of every row for the query terms."""
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        if not len(self.terms) or not query_terms:
+            return scores
+        query_terms = np.unique(np.array(query_terms))
+        positions = np.minimum(np.searchsorted(self.terms, query_terms), len(self.terms) - 1)
+        row_count = len(self.chunk_ids)
+        for position in positions[self.terms[positions] == query_terms]:
+            start, stop = self.offsets[position], self.offsets[position + 1]
+            rows, frequencies = self.rows[start:stop], self.frequencies[start:stop]
+            document_frequency = stop - start
+            idf = np.log1p((row_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[rows] / max(self.average_length, 1.0))
+            scores[rows] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+        return scores
+
+
+class BM25Index:
+    """Per-user BM25 keyword index over DocumentChunk.content.
+
+    Postings are written at ingest as compact .npz files in the user's vector directory: one
+    per document, or one per part ({document_id}.{part}.npz) when a document is streamed in
+    several. Each process merges a user's files into a UserPostings on first search and keeps
+    it until a document is added or removed.
+    """
+
+    _postings = OrderedDict()  # user_id -> (signature, UserPostings), least recently used first
+    _lock = threading.Lock()
+    _max_users = DEFAULT_MAX_USERS
+    enabled = True
+    rrf_k = DEFAULT_RRF_K
+    candidate_factor = DEFAULT_CANDIDATE_FACTOR
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls.enabled = bool(config.get("HYBRID_SEARCH_ENABLED", True))
+        cls.rrf_k = int(config.get("HYBRID_RRF_K", DEFAULT_RRF_K))
+        cls.candidate_factor = int(config.get("HYBRID_CANDIDATE_FACTOR", DEFAULT_CANDIDATE_FACTOR))
+        cls._max_users = int(config.get("BM25_CACHE_MAX_USERS", DEFAULT_MAX_USERS))
+
+    @staticmethod
+    def _directory(user_id) -> str:
+        directory = os.path.join(get_user_vector_directory(user_id), BM25_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    @staticmethod
+    def _document_of(filename: str) -> str:
+        return filename.split(".", 1)[0]
+
+    @classmethod
+    def add_document(cls, user_id, document_id, chunk_ids: list, texts: list, part: int = None) -> None:
+        """Writes the postings of one document's chunks, or of one part of them."""
+        counts = [Counter(tokenize(text)) for text in texts]
+        row_terms = [term for count in counts for term in count]
+        rows = np.repeat(np.arange(len(counts), dtype=np.int32), [len(count) for count in counts])
+        frequencies = np.fromiter((n for count in counts for n in count.values()), dtype=np.uint16,
+                                  count=len(row_terms))
+        terms, term_ids = np.unique(np.array(row_terms, dtype=str), return_inverse=True)
+        order = np.lexsort((rows, term_ids))
+
+        directory = cls._directory(user_id)
+        temp_path = os.path.join(directory, f".{document_id}.{uuid.uuid4().hex}.npz")
+        with open(temp_path, "wb") as file:
+            np.savez(
+                file,
+                chunk_ids=np.array([str(i) for i in chunk_ids], dtype=ID_DTYPE),
+                lengths=np.array([sum(count.values()) for count in counts], dtype=np.int32),
+                terms=terms,
+                offsets=np.searchsorted(term_ids[order], np.arange(len(terms) + 1)),
+                rows=rows[order],
+                frequencies=frequencies[order],
+            )
+        filename = f"{document_id}.npz" if part is None else f"{document_id}.{part}.npz"
+        os.replace(temp_path, os.path.join(directory, filename))
+
+    @classmethod
+    def _remove_files(cls, user_id, keep) -> None:
+        # Temporary files start with "." and so never match a document id
+        for entry in os.scandir(cls._directory(user_id)):
+            if entry.name.endswith(".npz") and not keep(cls._document_of(entry.name)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def remove_document(cls, user_id, document_id) -> None:
+        cls._remove_files(user_id, lambda document: document != str(document_id))
+
+    @classmethod
+    def prune(cls, user_id, live_document_ids) -> None:
+        """Removes the postings of documents that no longer exist."""
+        live = {str(document_id) for document_id in live_document_ids}
+        cls._remove_files(user_id, lambda document: document in live or not document)
+
+    @classmethod
+    def _backfill(cls, user_id, document_ids) -> None:
+        # Documents embedded before the keyword index existed
+        for document_id in document_ids:
+            chunks = (
+                DocumentChunk.query.with_entities(DocumentChunk.id, DocumentChunk.content)
+                .filter_by(document_id=document_id)
+                .order_by(DocumentChunk.chunk_index)
+                .all()
+            )
+            cls.add_document(user_id, document_id, [chunk.id for chunk in chunks], [chunk.content for chunk in chunks])
+
+    @classmethod
+    def get_user_postings(cls, user_id, document_ids) -> UserPostings:
+        directory = cls._directory(user_id)
+        files = {entry.name: entry.stat().st_mtime_ns for entry in os.scandir(directory)
+                 if entry.name.endswith(".npz") and not entry.name.startswith(".")}
+        documents = {cls._document_of(filename) for filename in files}
+        missing = [str(document_id) for document_id in document_ids if str(document_id) not in documents]
+        if missing:
+            # Deleted documents may still be selected; backfilling them would write empty files
+            # that prune() removes again, only for the next search to rewrite them. Documents still
+            # being ingested write their own parts, which a backfill would duplicate
+            missing = [
+                document_id for (document_id,) in Document.query.with_entities(Document.id)
+                .outerjoin(EmbeddingTask, EmbeddingTask.task_id == Document.task_id)
+                .filter(Document.id.in_(missing), Document.user_id == str(user_id), Document.delete == False,
+                        or_(EmbeddingTask.id.is_(None), EmbeddingTask.stage == "complete"))
+            ]
+        if missing:
+            cls._backfill(user_id, missing)
+            return cls.get_user_postings(user_id, [])
+
+        signature = tuple(sorted(files.items()))
+        with cls._lock:
+            cached = cls._postings.get(user_id)
+            if cached is not None and cached[0] == signature:
+                cls._postings.move_to_end(user_id)
+                return cached[1]
+
+        segments = []
+        for filename in sorted(files):
+            try:
+                with np.load(os.path.join(directory, filename)) as segment:
+                    segments.append((cls._document_of(filename), {name: segment[name] for name in segment.files}))
+            except FileNotFoundError:
+                pass  # Deleted while we were listing; the next search rebuilds without it
+        postings = UserPostings(segments)
+        with cls._lock:
+            cls._postings[user_id] = (signature, postings)
+            cls._postings.move_to_end(user_id)
+            while len(cls._postings) > cls._max_users:
+                cls._postings.popitem(last=False)
+        return postings
+
+    @classmethod
+    def search(cls, user_id, query_text: str, top_k: int, document_ids) -> list:
+        """Returns the top_k (chunk_id, score) keyword matches within document_ids."""
+        document_ids = [str(document_id) for document_id in document_ids]
+        postings = cls.get_user_postings(user_id, document_ids)
+        scores = postings.scores(tokenize(query_text))
+        selected = np.isin(np.array(postings.document_ids, dtype=object), document_ids)
+        scores[~selected[postings.row_documents]] = 0
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(scores[matched], -top_k)[-top_k:]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(postings.chunk_ids[row].decode(), float(scores[row])) for row in matched]
@@ -0,0 +1,94 @@
+import math
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pypdf import PdfReader
+
+DEFAULT_MIN_PAGES = 64  # Smaller PDFs are extracted inline; spawning workers costs more than it saves
+DEFAULT_WORKERS = max(1, min(4, (multiprocessing.cpu_count() or 1) - 1))
+MIN_PAGES_PER_RANGE = 8
+RANGES_PER_WORKER = 4  # Smaller ranges keep the output flowing; larger ones parse the file fewer times
+
+
+def extract_page_range(filepath: str, start: int, stop: int) -> list:
+    """Runs in a pool process: the (text, page_number) of pages start..stop-1 that have any text."""
+    with open(filepath, "rb") as file:
+        reader = PdfReader(file)
+        pages = []
+        for index in range(start, stop):
+            page_text = reader.pages[index].extract_text()
+            if page_text:
+                pages.append((page_text, index + 1))
+        return pages
+
+
+class PDFExtractionPool:
+    """Process pool for pypdf text extraction, which is pure-Python CPU work.
+
+    Workers are spawned rather than forked, so they inherit neither the eventlet monkey
+    patching nor the open database connections of the Celery worker, and they are kept for
+    the life of the process so the start-up cost is paid once.
+    """
+
+    _executor = None
+    _lock = threading.Lock()
+    min_pages = DEFAULT_MIN_PAGES
+    workers = DEFAULT_WORKERS
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls.min_pages = int(config.get("PDF_PARALLEL_MIN_PAGES", DEFAULT_MIN_PAGES))
+        cls.workers = int(config.get("PDF_EXTRACTION_WORKERS") or DEFAULT_WORKERS)
+
+    @classmethod
+    def enabled_for(cls, page_count: int) -> bool:
+        return cls.workers > 1 and page_count >= cls.min_pages
+
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(
+                    max_workers=cls.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return cls._executor
+
+    @classmethod
+    def _discard_executor(cls, executor) -> None:
+        with cls._lock:
+            if cls._executor is executor:
+                cls._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def extract(cls, filepath: str, page_count: int):
+        """Yields (text, page_number) in page order, extracting page ranges in parallel.
+
+        Only a few ranges per worker are outstanding at once, so a slow consumer holds back
+        extraction instead of letting finished pages pile up in memory.
+        """
+        executor = cls._get_executor()
+        range_size = max(MIN_PAGES_PER_RANGE, math.ceil(page_count / (cls.workers * RANGES_PER_WORKER)))
+        starts = iter(range(0, page_count, range_size))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < cls.workers * 2:
+                    start = next(starts, None)
+                    if start is None:
+                        break
+                    pending.append(
+                        executor.submit(extract_page_range, filepath, start, min(start + range_size, page_count))
+                    )
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        except BrokenProcessPool:
+            cls._discard_executor(executor)  # A worker died; the next document gets a fresh pool
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 3600
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of query embeddings keyed by (sha256 of the normalised text, model, dimensions).
+
+    Entries expire after a TTL. With QUERY_EMBEDDING_CACHE_DIR set, entries are also written
+    through to disk so they survive restarts and are shared by every worker process.
+    """
+
+    _entries = OrderedDict()  # key -> (stored_at, float32 vector)
+    _lock = threading.Lock()
+    _max_entries = DEFAULT_MAX_ENTRIES
+    _ttl = DEFAULT_TTL_SECONDS
+    _spill_directory = None
+    _hits = 0
+    _misses = 0
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls._max_entries = int(config.get("QUERY_EMBEDDING_CACHE_SIZE", DEFAULT_MAX_ENTRIES))
+        cls._ttl = float(config.get("QUERY_EMBEDDING_CACHE_TTL", DEFAULT_TTL_SECONDS))
+        cls._spill_directory = config.get("QUERY_EMBEDDING_CACHE_DIR")
+        if cls._spill_directory:
+            os.makedirs(cls._spill_directory, exist_ok=True)
+
+    @staticmethod
+    def key(text: str, model: str, dimensions: int) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{digest}-{model}-{dimensions}"
+
+    @classmethod
+    def _spill_path(cls, key: str) -> str:
+        return os.path.join(cls._spill_directory, f"{key}.npy")
+
+    @classmethod
+    def get(cls, key: str):
+        now = time.time()
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is not None and now - entry[0] < cls._ttl:
+                cls._entries.move_to_end(key)
+                cls._hits += 1
+                return entry[1]
+            cls._entries.pop(key, None)
+
+        vector, stored_at = cls._read_spill(key, now)
+        with cls._lock:
+            if vector is None:
+                cls._misses += 1
+                return None
+            cls._hits += 1
+            cls._remember(key, vector, stored_at)
+        return vector
+
+    @classmethod
+    def _read_spill(cls, key: str, now: float) -> tuple:
+        """Returns (vector, time it was stored), or (None, None) if there is no fresh spill file."""
+        if not cls._spill_directory:
+            return None, None
+        path = cls._spill_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at >= cls._ttl:
+                os.remove(path)
+                return None, None
+            return np.load(path), stored_at
+        except (FileNotFoundError, ValueError, OSError):
+            # Also when prune() or another process removed the file since it was found
+            return None, None
+
+    @classmethod
+    def _remember(cls, key: str, vector: np.ndarray, stored_at: float) -> None:
+        cls._entries[key] = (stored_at, vector)
+        cls._entries.move_to_end(key)
+        while len(cls._entries) > cls._max_entries:
+            cls._entries.popitem(last=False)
+
+    @classmethod
+    def put(cls, key: str, vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)  # Shared between requests, so nobody may modify it in place
+        with cls._lock:
+            cls._remember(key, vector, time.time())
+        if cls._spill_directory:
+            temp_path = os.path.join(cls._spill_directory, f".{key}.{uuid.uuid4().hex}")
+            with open(temp_path, "wb") as file:
+                np.save(file, vector)
+            os.replace(temp_path, cls._spill_path(key))
+        return vector
+
+    @classmethod
+    def prune(cls) -> int:
+        """Removes expired spill files and returns how many were deleted."""
+        if not cls._spill_directory:
+            return 0
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(cls._spill_directory):
+            try:
+                if entry.name.endswith(".npy") and now - entry.stat().st_mtime >= cls._ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._entries.clear()
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"entries": len(cls._entries), "max_entries": cls._max_entries, "hits": cls._hits,
+                    "misses": cls._misses}
@@ -0,0 +1,265 @@
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from app.utils.logging_util import configure_logging
+
+logger = configure_logging()
+
+INTERACTIVE = 0  # Chat and other requests a user is waiting on
+BACKGROUND = 1  # Celery jobs: embeddings, preprocessing, transcription
+DEFAULT_RPM = 500  # Until a response tells us the key's real limits
+DEFAULT_TPM = 200000
+DEFAULT_INTERACTIVE_RESERVE = 0.2  # Share of each bucket background work leaves for interactive requests
+DEFAULT_MAX_CLIENTS = 32  # Cached httpx clients per process, one per (key, priority, timeout)
+CHARS_PER_TOKEN = 4
+MAX_WAIT_SLICE = 1.0  # Waiters re-check at least this often, limits can be learnt while they sleep
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str) -> float:
+    """Seconds in an x-ratelimit-reset-* value such as "1s", "6m0s" or "20ms"."""
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in DURATION_PART.findall(value or ""))
+
+
+def parse_retry_after(headers: httpx.Headers) -> float:
+    """Seconds a 429 asks us to wait, from retry-after-ms or retry-after given as seconds or an HTTP date."""
+    try:
+        return max(float(headers.get("retry-after-ms")) / 1000, 0.0)
+    except (TypeError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if not value:
+        return 0.0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0  # Unparseable, or a date without a timezone
+
+
+def describe_request(request: httpx.Request) -> tuple:
+    """(model, rough token cost) of a request. JSON bodies cost their text plus whatever completion
+    they ask for; multipart uploads only name their model. Requests without one fall back to the path."""
+    if "json" in request.headers.get("content-type", ""):
+        body = request.content
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            payload = {}
+        model = payload.get("model")
+        tokens = len(body) // CHARS_PER_TOKEN + int(payload.get("max_tokens") or 0)
+    else:
+        # Audio uploads and the like are limited by requests, not tokens
+        fields = getattr(request.stream, "fields", ())
+        model = next((getattr(field, "value", None) for field in fields if getattr(field, "name", None) == "model"), None)
+        tokens = 0
+    return str(model or request.url.path), tokens
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, reserve: float, now: float) -> float:
+        """Seconds until amount can be taken while keeping reserve * capacity in the bucket.
+
+        A request bigger than what the reserve leaves room for goes through once the bucket is full.
+        """
+        self.refill(now)
+        needed = min(min(amount, self.capacity) + reserve * self.capacity, self.capacity)
+        return max(self.blocked_until - now, (needed - self.level) * 60 / self.capacity, 0.0)
+
+    def learn(self, limit, remaining, reset, now: float) -> None:
+        # The server's count also includes other processes using the key, so it wins when lower
+        self.refill(now)
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+        if remaining is not None and float(remaining) <= 0 and reset:
+            self.blocked_until = now + reset
+
+
+class KeyLimiter:
+    """Request and token buckets for one API key and model, served strictly in (priority, arrival) order."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.condition = threading.Condition()
+        self.waiting = []  # Heap of (priority, ticket)
+        self.tickets = itertools.count()
+
+    def acquire(self, tokens: int, priority: int, interactive_reserve: float) -> float:
+        """Blocks until the request may be sent and returns how long that took."""
+        started = time.monotonic()
+        entry = (priority, next(self.tickets))
+        reserve = interactive_reserve if priority != INTERACTIVE else 0.0
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    wait = MAX_WAIT_SLICE
+                    if self.waiting[0] == entry:
+                        now = time.monotonic()
+                        wait = max(self.requests.wait_time(1, reserve, now), self.tokens.wait_time(tokens, reserve, now))
+                        if wait <= 0:
+                            self.requests.level -= 1
+                            self.tokens.level -= tokens  # May go negative; later requests wait off the debt
+                            return time.monotonic() - started
+                    self.condition.wait(timeout=min(wait, MAX_WAIT_SLICE))
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def learn(self, headers: httpx.Headers, status_code: int) -> None:
+        now = time.monotonic()
+        with self.condition:
+            self.requests.learn(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"),
+                                parse_reset(headers.get("x-ratelimit-reset-requests")), now)
+            self.tokens.learn(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"),
+                              parse_reset(headers.get("x-ratelimit-reset-tokens")), now)
+            if status_code == 429:
+                # Hold everyone back until the window resets instead of letting retries pile on
+                retry_after = parse_retry_after(headers) or max(
+                    parse_reset(headers.get("x-ratelimit-reset-requests")),
+                    parse_reset(headers.get("x-ratelimit-reset-tokens")), 1.0)
+                self.requests.blocked_until = max(self.requests.blocked_until, now + retry_after)
+            self.condition.notify_all()
+
+    def depth(self) -> dict:
+        with self.condition:
+            interactive = sum(1 for priority, _ in self.waiting if priority == INTERACTIVE)
+            return {"interactive": interactive, "background": len(self.waiting) - interactive}
+
+
+class RateLimitScheduler:
+    """Per-process scheduler for every OpenAI request made with a user's API key.
+
+    Requests wait on per-key, per-model token buckets for requests/min and tokens/min, as OpenAI
+    limits each model separately. The buckets start from defaults and are corrected by the
+    x-ratelimit-* headers of each response, which also account for traffic from other
+    processes using the same key. Interactive requests are
+    served before queued background ones, and background work never drains the last
+    RATE_LIMIT_INTERACTIVE_RESERVE of a bucket, which keeps headroom for chat in other processes too.
+    """
+
+    _limiters = {}  # (api_key_id, model) -> KeyLimiter
+    _clients = OrderedDict()  # (api_key_id, priority, timeout) -> (httpx.Client, transport), least recently used first
+    _lock = threading.Lock()
+    _rpm = DEFAULT_RPM
+    _tpm = DEFAULT_TPM
+    _interactive_reserve = DEFAULT_INTERACTIVE_RESERVE
+    _max_clients = DEFAULT_MAX_CLIENTS
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls._rpm = int(config.get("RATE_LIMIT_DEFAULT_RPM", DEFAULT_RPM))
+        cls._tpm = int(config.get("RATE_LIMIT_DEFAULT_TPM", DEFAULT_TPM))
+        cls._interactive_reserve = float(config.get("RATE_LIMIT_INTERACTIVE_RESERVE", DEFAULT_INTERACTIVE_RESERVE))
+        cls._max_clients = int(config.get("RATE_LIMIT_MAX_CLIENTS", DEFAULT_MAX_CLIENTS))
+
+    @classmethod
+    def limiter(cls, api_key_id, model: str) -> KeyLimiter:
+        key = (str(api_key_id), model)
+        with cls._lock:
+            limiter = cls._limiters.get(key)
+            if limiter is None:
+                limiter = cls._limiters[key] = KeyLimiter(cls._rpm, cls._tpm)
+            return limiter
+
+    @classmethod
+    def http_client(cls, api_key_id, priority: int, timeout=None) -> httpx.Client:
+        """An httpx client for OpenAI(http_client=...) whose requests go through the scheduler.
+
+        Clients are cached so their connection pools are reused, up to RATE_LIMIT_MAX_CLIENTS.
+        The least recently used one beyond that has its connections closed; an OpenAI client
+        still holding it simply reconnects on its next request.
+        """
+        key = (str(api_key_id), priority, timeout)
+        evicted = []
+        with cls._lock:
+            cached = cls._clients.get(key)
+            if cached is None:
+                transport = RateLimitedTransport(api_key_id, priority, cls._interactive_reserve)
+                cached = cls._clients[key] = (httpx.Client(transport=transport, timeout=timeout,
+                                                           follow_redirects=True), transport)
+                while len(cls._clients) > cls._max_clients:
+                    evicted.append(cls._clients.popitem(last=False)[1][1])
+            cls._clients.move_to_end(key)
+        for transport in evicted:
+            transport.close()
+        return cached[0]
+
+    @classmethod
+    def queue_depth(cls, api_key_id) -> dict:
+        """Queued requests for a key, across all of its models."""
+        with cls._lock:
+            limiters = [limiter for (key, _), limiter in cls._limiters.items() if key == str(api_key_id)]
+        depths = [limiter.depth() for limiter in limiters]
+        return {
+            "interactive": sum(depth["interactive"] for depth in depths),
+            "background": sum(depth["background"] for depth in depths),
+        }
+
+    @classmethod
+    def stats(cls, api_key_id=None) -> dict:
+        """Bucket levels and queue depth per limiter in this process, for one key if given."""
+        with cls._lock:
+            limiters = {key: limiter for key, limiter in cls._limiters.items()
+                        if api_key_id is None or key[0] == str(api_key_id)}
+        return {
+            f"{key}:{model}": {
+                **limiter.depth(),
+                "requests_per_minute": limiter.requests.capacity,
+                "tokens_per_minute": limiter.tokens.capacity,
+                "requests_available": limiter.requests.level,
+                "tokens_available": limiter.tokens.level,
+            }
+            for (key, model), limiter in limiters.items()
+        }
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, api_key_id, priority: int, interactive_reserve: float):
+        self.api_key_id = api_key_id
+        self.priority = priority
+        self.interactive_reserve = interactive_reserve
+        self.transport = httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = describe_request(request)
+        limiter = RateLimitScheduler.limiter(self.api_key_id, model)
+        waited = limiter.acquire(tokens, self.priority, self.interactive_reserve)
+        if waited > MAX_WAIT_SLICE:
+            logger.info(f"Waited {waited:.1f}s for rate limit on {model} "
+                        f"({RateLimitScheduler.queue_depth(self.api_key_id)} queued for the key)")
+        response = self.transport.handle_request(request)
+        limiter.learn(response.headers, response.status_code)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
@@ -6,6 +6,14 @@ from app.utils.logging_util import configure_logging
 
 logger = configure_logging()
 
+
+def prewarm_vectors(user_id):
+    # Imported here because app/__init__ imports this module before the models exist
+    from app.utils.vector_cache import VectorCache
+
+    VectorCache.prewarm(user_id)
+
+
 class GlobalNamespace(Namespace):
     def on_connect(self):
         # Check if the user is authenticated
@@ -27,6 +35,7 @@ class EmbeddingNamespace(Namespace):
         else:
             emit("my_response", {"data": "Connected to the namespace"})
             join_room(str(current_user.id))
+            prewarm_vectors(current_user.id)
 
     def on_disconnect(self):
         logger.info("Client disconnected from the embedding namespace")
@@ -64,6 +73,7 @@ class CWDNamespace(Namespace):
         else:
             logger.info(f"Authenticated user {current_user.id} connected to the CWD namespace")
             join_room(str(current_user.id))
+            prewarm_vectors(current_user.id)
 
     def on_disconnect(self):
         logger.info("Client disconnected from the CWD namespace")
@@ -1,15 +1,258 @@
-import pickle
+import copy
+import sys
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sqlalchemy.orm import load_only
+from flask import current_app
 
 from app.models.embedding_models import Document, DocumentChunk, DocumentEmbedding
+from app.models.user_models import TierLimit, User
+from app.utils.ann_index import ANNIndex
+from app.utils.vector_store import SegmentedVectors, VectorStore, ID_DTYPE
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # Memory budget shared by all cached users
+DEFAULT_COARSE_DIMS = None  # Matryoshka prefix length scanned before the full-dimension rescore; opt-in, it costs recall
+DEFAULT_TWO_STAGE_MIN_ROWS = 10000  # Below this a single exact scan is already fast
+DEFAULT_RERANK_FACTOR = 10  # Coarse candidates kept per requested result
+DEFAULT_ROUTING_MIN_ROWS = 10000  # Below this routing saves less than scoring the centroids costs
+DEFAULT_ROUTING_MIN_SPREAD = 0.05  # Best centroid score over the median needed to trust the routing
+DEFAULT_PREWARM_WORKERS = 2
+DEFAULT_DIVERSITY_FACTOR = 4  # Candidates gathered per requested result when diversifying
+MIN_RUN_ROWS = 32  # Average run length above which a subset is scored slice by slice
+SUBSET_GATHER_RATIO = 4  # Subsets above 1/4 of a user's rows are scored in place rather than gathered
+SCAN_BLOCK_ROWS = 128  # Rows upcast at a time for int8/float16 scans; small enough to stay in CPU cache
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple:
+    """Symmetric per-row int8 quantisation; row i is approximately codes[i] * scales[i]."""
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SCAN_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+        block_scales = np.maximum(np.abs(block).max(axis=1), np.finfo(np.float32).tiny) / 127.0
+        codes[start:start + len(block)] = np.rint(block / block_scales[:, None])
+        scales[start:start + len(block)] = block_scales
+    return codes, scales
+
+
+def append_rows(matrix, rows: np.ndarray) -> SegmentedVectors:
+    """matrix with rows after it, sharing both instead of concatenating them into a new array."""
+    if isinstance(matrix, SegmentedVectors):
+        return matrix.appended(rows)
+    return SegmentedVectors([matrix, rows])
+
+
+def document_centroid(matrix: np.ndarray) -> np.ndarray:
+    """Normalised mean of a document's normalised chunk embeddings."""
+    return normalize_rows(normalize_rows(np.asarray(matrix, dtype=np.float32)).mean(axis=0))
+
+
+def build_scan(vectors: np.ndarray, scan_dims: int, quantization: str) -> tuple:
+    """Returns the (scan, scale) first-stage matrices; either may be None."""
+    scan = None
+    if scan_dims is not None:
+        # text-embedding-3 vectors stay meaningful when truncated, once renormalised
+        scan = normalize_rows(np.asarray(vectors[:, :scan_dims], dtype=np.float32))
+    if quantization == "int8":
+        return quantize_int8(scan if scan is not None else vectors)
+    return scan, None
+
+
+class UserVectors:
+    """The cached embedding matrix of a single user.
+
+    Shards are never mutated once published; extended() and withdrawn() return updated
+    copies so concurrent searches always see a consistent shard.
+    """
+
+    def __init__(self, vectors: np.ndarray, ids: list, document_ids: np.ndarray = None, signature=None,
+                 coarse_dims: int = None, quantization: str = None, ann: ANNIndex = None, segments: list = None,
+                 tombstones=(), prebuilt_scan: tuple = None, centroids: dict = None):
+        self.vectors = vectors  # Full-dimension vectors, used for exact scoring; memmapped, never copied
+        self.ids = ids
+        self.document_ids = document_ids
+        self.index = {chunk_id: row for row, chunk_id in enumerate(ids)}  # chunk_id -> row in vectors
+        self.signature = signature
+        self.segments = segments or []  # VectorStore segments already reflected in this shard
+        self.ann = ann
+        self.alive = None  # Row mask once any chunk has been removed in place
+        self._documents = None  # Lazily built (distinct document ids, document position of each row)
+        self._selection = None  # (selection signature, rows of the selected documents)
+        self.stored_centroids = centroids or {}  # document_id -> centroid saved at ingest
+        self._centroids = None  # Lazily built centroid matrix, aligned with document_index()
+
+        # Optional first-stage matrix, scanned in place of the full vectors before an exact rerank
+        self.coarse_dims = coarse_dims  # As resolved from the tier, kept for shards that start out empty
+        self.scan_dims = self.scan_dims_for(coarse_dims, vectors) if len(ids) else None
+        self.quantization = quantization
+        if prebuilt_scan is not None:
+            self.scan, self.scan_scale = prebuilt_scan
+        else:
+            self.scan, self.scan_scale = self._build_scan(vectors) if len(ids) else (None, None)
+        if len(self.index) != len(ids):
+            # A chunk written twice (an append that raced a backfill) is only current in its last row
+            self.alive = np.zeros(len(ids), dtype=bool)
+            self.alive[list(self.index.values())] = True
+        if len(tombstones):
+            self._withdraw([chunk_id.decode() for chunk_id in tombstones])
+
+    @staticmethod
+    def scan_dims_for(coarse_dims: int, vectors: np.ndarray):
+        return coarse_dims if coarse_dims and 0 < coarse_dims < vectors.shape[1] else None
+
+    def _build_scan(self, vectors: np.ndarray) -> tuple:
+        return build_scan(vectors, self.scan_dims, self.quantization)
+
+    def _withdraw(self, chunk_ids) -> None:
+        rows = [self.index.pop(chunk_id) for chunk_id in chunk_ids if chunk_id in self.index]
+        if rows:
+            self.alive = np.ones(len(self.ids), dtype=bool) if self.alive is None else self.alive.copy()
+            self.alive[rows] = False
+
+    def extended(self, vectors: np.ndarray, ids: list, document_ids: np.ndarray, segment: str, signature):
+        """Returns a copy of this shard with rows appended, reusing everything already computed."""
+        if not self.ids:
+            ann = self.ann.extended(vectors) if self.ann is not None else None
+            return UserVectors(vectors, ids, document_ids, signature, self.coarse_dims, self.quantization, ann,
+                               segments=self.segments + [segment], centroids=self.stored_centroids)
+        shard = copy.copy(self)
+        replaced = [chunk_id for chunk_id in ids if chunk_id in self.index]
+        shard.index = dict(self.index)
+        if replaced:
+            shard._withdraw(replaced)
+        shard.vectors = append_rows(self.vectors, vectors)
+        shard.index.update((chunk_id, len(self.ids) + row) for row, chunk_id in enumerate(ids))
+        shard.ids = self.ids + ids
+        shard.document_ids = np.concatenate([self.document_ids, document_ids])
+        shard.segments = self.segments + [segment]
+        shard.signature = signature
+        shard._documents = None
+        shard._selection = None
+        shard._centroids = None
+        if shard.alive is not None:
+            shard.alive = np.concatenate([shard.alive, np.ones(len(ids), dtype=bool)])
+        scan, scan_scale = self._build_scan(vectors)
+        if scan is not None:
+            shard.scan = append_rows(self.scan, scan)
+        if scan_scale is not None:
+            shard.scan_scale = np.concatenate([self.scan_scale, scan_scale])
+        if self.ann is not None:
+            shard.ann = self.ann.extended(vectors)
+        return shard
+
+    def withdrawn(self, chunk_ids, signature):
+        """Returns a copy of this shard with the given chunks tombstoned."""
+        shard = copy.copy(self)
+        shard.index = dict(self.index)
+        shard._withdraw([str(chunk_id) for chunk_id in chunk_ids])
+        shard.signature = signature
+        shard._selection = None
+        return shard
+
+    def live_rows(self):
+        return None if self.alive is None else np.flatnonzero(self.alive)
+
+    def scan_query(self, query_vector: np.ndarray) -> np.ndarray:
+        if self.scan_dims is None:
+            return query_vector
+        return normalize_rows(query_vector[: self.scan_dims])
+
+    def document_index(self) -> tuple:
+        """Returns the distinct document ids and, for each row, the position of its document among them."""
+        if self._documents is None:
+            self._documents = np.unique(self.document_ids, return_inverse=True)
+        return self._documents
+
+    def document_centroids(self) -> np.ndarray:
+        """Returns one centroid per distinct document, in document_index() order."""
+        if self._centroids is None:
+            documents, row_documents = self.document_index()
+            centroids = np.empty((len(documents), self.vectors.shape[1]), dtype=np.float32)
+            missing = []
+            for position, document_id in enumerate(documents):
+                stored = self.stored_centroids.get(document_id)
+                if stored is not None and len(stored) == centroids.shape[1]:
+                    centroids[position] = stored
+                else:
+                    missing.append(position)
+            if missing:
+                # Documents embedded before centroids were stored, or appended since the load
+                order = np.argsort(row_documents, kind="stable")
+                bounds = np.searchsorted(row_documents[order], np.arange(len(documents) + 1))
+                for position in missing:
+                    centroids[position] = document_centroid(self.vectors[order[bounds[position]:bounds[position + 1]]])
+            self._centroids = centroids
+        return self._centroids
+
+    def rows_for_documents(self, document_ids) -> np.ndarray:
+        documents, row_documents = self.document_index()
+        selected = np.isin(documents, np.array([str(i) for i in document_ids], dtype=ID_DTYPE))[row_documents]
+        if self.alive is not None:
+            selected &= self.alive
+        return np.flatnonzero(selected)
+
+    def rows_for_selection(self, signature, selected_document_ids: np.ndarray) -> np.ndarray:
+        # Only recomputed when the user changes their selection; other queries reuse the rows
+        cached = self._selection
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        documents, row_documents = self.document_index()
+        selected = np.isin(documents, selected_document_ids)[row_documents]
+        if self.alive is not None:
+            selected &= self.alive
+        rows = np.flatnonzero(selected)
+        self._selection = (signature, rows)
+        return rows
+
+    def rows_for(self, chunk_ids) -> np.ndarray:
+        rows = [self.index.get(str(chunk_id)) for chunk_id in chunk_ids]
+        return np.fromiter((row for row in rows if row is not None), dtype=np.intp)
+
+    @property
+    def nbytes(self) -> int:
+        # Memory-mapped arrays live in the shared page cache rather than this process, but the
+        # per-row id list and index are private and outgrow the arrays once those are mapped
+        nbytes = sys.getsizeof(self.ids) + sys.getsizeof(self.index)
+        if self.ids:
+            nbytes += len(self.ids) * sys.getsizeof(self.ids[0])  # Chunk ids are all uuid strings
+            nbytes += len(self.index) * sys.getsizeof(len(self.ids))  # Row numbers in the index
+        for part in (self.vectors, self.scan, self.scan_scale, self.ann, self.alive, self.document_ids):
+            if isinstance(part, SegmentedVectors):
+                nbytes += part.resident_nbytes
+            elif part is not None and not isinstance(part, np.memmap):
+                nbytes += part.nbytes
+        return nbytes
 
 
 class VectorCache:
     _instance = None
-    _vectors = np.array([])  # Store vectors as a single numpy array
-    _ids = []  # Store corresponding chunk IDs
+    _shards = OrderedDict()  # user_id -> UserVectors, least recently used first
+    _selections = {}  # user_id -> (selection signature, selected document ids)
+    _max_bytes = DEFAULT_MAX_BYTES
+    _current_bytes = 0
+    _hits = 0
+    _misses = 0
+    _evictions = 0
+    _coarse_dims = DEFAULT_COARSE_DIMS
+    _two_stage_min_rows = DEFAULT_TWO_STAGE_MIN_ROWS
+    _rerank_factor = DEFAULT_RERANK_FACTOR
+    _quantization = None
+    _mmr_lambda = None  # Relevance weight for Maximal Marginal Relevance; None keeps the ranking as is
+    _dedupe_threshold = None  # Cosine similarity above which a candidate counts as a duplicate
+    _diversity_factor = DEFAULT_DIVERSITY_FACTOR
+    _routing_top_documents = None  # Documents scanned after centroid routing; None scans them all
+    _routing_min_rows = DEFAULT_ROUTING_MIN_ROWS
+    _routing_min_spread = DEFAULT_ROUTING_MIN_SPREAD
+    _prewarm_workers = DEFAULT_PREWARM_WORKERS
+    _prewarm_executor = None
+    _prewarming = {}  # user_id -> Future of an in-flight background load
     _lock = threading.RLock()
 
     def __new__(cls):
@@ -18,50 +261,492 @@ class VectorCache:
         return cls._instance
 
     @classmethod
-    def clear_cache(cls) -> None:
+    def configure(cls, config) -> None:
+        with cls._lock:
+            cls._max_bytes = int(config.get("VECTOR_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+            coarse_dims = config.get("VECTOR_CACHE_COARSE_DIMS", DEFAULT_COARSE_DIMS)
+            cls._coarse_dims = None if coarse_dims is None else int(coarse_dims)
+            cls._two_stage_min_rows = int(config.get("VECTOR_CACHE_TWO_STAGE_MIN_ROWS", DEFAULT_TWO_STAGE_MIN_ROWS))
+            cls._rerank_factor = int(config.get("VECTOR_CACHE_RERANK_FACTOR", DEFAULT_RERANK_FACTOR))
+            cls._quantization = config.get("VECTOR_CACHE_QUANTIZATION")
+            mmr_lambda = config.get("RETRIEVAL_MMR_LAMBDA")
+            dedupe_threshold = config.get("RETRIEVAL_DEDUPE_THRESHOLD")
+            cls._mmr_lambda = None if mmr_lambda is None else float(mmr_lambda)
+            cls._dedupe_threshold = None if dedupe_threshold is None else float(dedupe_threshold)
+            cls._diversity_factor = int(config.get("RETRIEVAL_DIVERSITY_FACTOR", DEFAULT_DIVERSITY_FACTOR))
+            routing_top_documents = config.get("VECTOR_ROUTING_TOP_DOCUMENTS")
+            cls._routing_top_documents = None if routing_top_documents is None else int(routing_top_documents)
+            cls._routing_min_rows = int(config.get("VECTOR_ROUTING_MIN_ROWS", DEFAULT_ROUTING_MIN_ROWS))
+            cls._routing_min_spread = float(config.get("VECTOR_ROUTING_MIN_SPREAD", DEFAULT_ROUTING_MIN_SPREAD))
+            cls._prewarm_workers = int(config.get("VECTOR_CACHE_PREWARM_WORKERS", DEFAULT_PREWARM_WORKERS))
+            cls._evict_over_budget()
+
+    @classmethod
+    def clear_cache(cls, user_id=None) -> None:
+        with cls._lock:
+            if user_id is None:
+                cls._shards.clear()
+                cls._selections.clear()
+                cls._current_bytes = 0
+                return
+            cls._selections.pop(str(user_id), None)
+            shard = cls._shards.pop(str(user_id), None)
+            if shard is not None:
+                cls._current_bytes -= shard.nbytes
+
+    @classmethod
+    def stats(cls) -> dict:
         with cls._lock:
-            cls._vectors = np.array([])
-            cls._ids = []
+            return {
+                "users": len(cls._shards),
+                "bytes": cls._current_bytes,
+                "max_bytes": cls._max_bytes,
+                "hits": cls._hits,
+                "misses": cls._misses,
+                "evictions": cls._evictions,
+            }
 
     @classmethod
-    def load_user_vectors(cls, user_id: int) -> None:
-        cls.clear_cache()
-        embeddings = (
+    def _database_rows(cls, user_id) -> tuple:
+        rows = (
             DocumentEmbedding.query
             .join(DocumentChunk, DocumentChunk.id == DocumentEmbedding.chunk_id)
             .join(Document, Document.id == DocumentChunk.document_id)
             .filter(DocumentEmbedding.user_id == user_id, Document.delete == False)
-            .options(load_only(DocumentEmbedding.chunk_id, DocumentEmbedding.embedding))
+            .with_entities(DocumentEmbedding.chunk_id, DocumentChunk.document_id, DocumentEmbedding.embedding)
+            .order_by(DocumentChunk.document_id, DocumentChunk.chunk_index)  # Keep each document's rows together
             .all()
         )
+        if not rows:
+            return [], [], np.empty((0, 0), dtype=np.float32)
+        vectors = np.stack([np.frombuffer(row.embedding, dtype=np.float32) for row in rows])
+        return [row.chunk_id for row in rows], [row.document_id for row in rows], vectors
 
-        if not embeddings:
-            cls.clear_cache()
-            return
+    @classmethod
+    def _stored_centroids(cls, user_id) -> dict:
+        if cls._routing_top_documents is None:
+            return {}
+        documents = (
+            Document.query.with_entities(Document.id, Document.centroid)
+            .filter(Document.user_id == user_id, Document.centroid.isnot(None))
+            .all()
+        )
+        return {
+            document_id.encode(): np.frombuffer(centroid, dtype=np.float32) for document_id, centroid in documents
+        }
 
-        with cls._lock:
-            cls._vectors = np.stack([np.frombuffer(embedding.embedding, dtype=np.float32) for embedding in embeddings])
-            cls._ids = [str(embedding.chunk_id) for embedding in embeddings]
+    @classmethod
+    def _tier_coarse_dims(cls, user_id) -> int:
+        # A tier's embed_dimensions sets how many leading dimensions the first stage scans
+        dimensions = (
+            TierLimit.query.join(User, User.role_id == TierLimit.role_id)
+            .filter(User.id == user_id)
+            .with_entities(TierLimit.embed_dimensions)
+            .scalar()
+        )
+        return dimensions or cls._coarse_dims
+
+    @classmethod
+    def _fetch(cls, user_id) -> UserVectors:
+        store = VectorStore(user_id)
+        if not store.is_backfilled():
+            store.backfill(lambda: cls._database_rows(user_id))
+
+        vectors, chunk_ids, document_ids, manifest = store.load()
+        index_class = ANNIndex.configured()
+        ann = None
+        if index_class is not None and len(chunk_ids) >= ANNIndex.min_rows:
+            ann = index_class.load(store.directory, chunk_ids, vectors)
+
+        coarse_dims = cls._tier_coarse_dims(user_id)
+        prebuilt_scan = None
+        scan_dims = UserVectors.scan_dims_for(coarse_dims, vectors) if len(chunk_ids) else None
+        if scan_dims is not None or cls._quantization == "int8":
+            # Every worker maps the same first-stage matrix instead of computing its own copy
+            arrays = store.shared_arrays(
+                f"scan-{scan_dims or 'full'}-{cls._quantization or 'float32'}",
+                manifest["version"],
+                lambda: cls._scan_arrays(vectors, scan_dims),
+            )
+            prebuilt_scan = (arrays["scan"], arrays.get("scale"))
+
+        return UserVectors(
+            vectors,
+            [chunk_id.decode() for chunk_id in chunk_ids],
+            document_ids,
+            manifest["version"],
+            coarse_dims=coarse_dims,
+            quantization=cls._quantization,
+            ann=ann,
+            segments=manifest["segments"],
+            tombstones=store.tombstones(),
+            prebuilt_scan=prebuilt_scan,
+            centroids=cls._stored_centroids(user_id),
+        )
 
     @classmethod
-    def mips_naive(cls, query_vector: np.ndarray, subset_ids: list) -> list:
+    def _scan_arrays(cls, vectors: np.ndarray, scan_dims) -> dict:
+        scan, scale = build_scan(vectors, scan_dims, cls._quantization)
+        return {"scan": scan} if scale is None else {"scan": scan, "scale": scale}
+
+    @classmethod
+    def save_selection(cls, user_id) -> None:
+        """Publishes the user's selected documents to every process; call after committing a change."""
+        document_ids = [
+            document_id
+            for (document_id,) in Document.query.with_entities(Document.id).filter_by(user_id=user_id, selected=True)
+        ]
+        VectorStore(user_id).save_selection(document_ids)
+
+    @classmethod
+    def selected_documents(cls, user_id) -> tuple:
+        """Returns (signature, selected document ids), re-reading them only after a change."""
+        key = str(user_id)
+        store = VectorStore(user_id)
+        signature = store.selection_signature()
+        cached = cls._selections.get(key)
+        if cached is not None and signature is not None and cached[0] == signature:
+            return cached
+        if signature is None:
+            cls.save_selection(user_id)
+        selection = store.selection()
+        cls._selections[key] = selection
+        return selection
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        # Positions of the top_k highest scores in descending order, without sorting everything
+        if top_k <= 0 or scores.size == 0:
+            return np.empty(0, dtype=np.intp)
+        if top_k < scores.size:
+            candidates = np.argpartition(scores, -top_k)[-top_k:]
+        else:
+            candidates = np.arange(scores.size)
+        return candidates[np.argsort(scores[candidates])[::-1]]
+
+    @staticmethod
+    def _validate_query(query_vector) -> None:
         if not isinstance(query_vector, np.ndarray):
             raise ValueError("Query vector must be a numpy array.")
         if query_vector.ndim != 1:
             raise ValueError("Query vector must be a 1D array.")
 
+    @classmethod
+    def _store(cls, user_id: str, shard: UserVectors) -> None:
+        with cls._lock:
+            previous = cls._shards.pop(user_id, None)
+            if previous is not None:
+                cls._current_bytes -= previous.nbytes
+            cls._shards[user_id] = shard
+            cls._current_bytes += shard.nbytes
+            cls._evict_over_budget()
+
+    @classmethod
+    def _evict_over_budget(cls) -> None:
+        # The most recently used shard is always kept, even if it alone exceeds the budget
+        while cls._current_bytes > cls._max_bytes and len(cls._shards) > 1:
+            _, evicted = cls._shards.popitem(last=False)
+            cls._current_bytes -= evicted.nbytes
+            cls._evictions += 1
+
+    @classmethod
+    def load_user_vectors(cls, user_id) -> UserVectors:
+        """Reopens a user's on-disk vectors, replacing any cached copy."""
+        shard = cls._fetch(user_id)
+        cls._store(str(user_id), shard)
+        return shard
+
+    @classmethod
+    def _refreshed(cls, shard: UserVectors, store: VectorStore):
+        """Applies segments and tombstones written by other processes, or None if a reload is needed."""
+        manifest = store.read_manifest()
+        if manifest["version"] == shard.signature:
+            return shard
+        if not manifest["backfilled"] or not set(shard.segments) <= set(manifest["segments"]):
+            return None  # The store was rebuilt or compacted underneath this shard
+        try:
+            for segment in manifest["segments"]:
+                if segment not in shard.segments:
+                    vectors, chunk_ids, document_ids = store.open_segment(segment)
+                    ids = [chunk_id.decode() for chunk_id in chunk_ids]
+                    shard = shard.extended(vectors, ids, document_ids, segment, manifest["version"])
+        except FileNotFoundError:
+            return None
+        return shard.withdrawn([chunk_id.decode() for chunk_id in store.tombstones()], manifest["version"])
+
+    @classmethod
+    def ensure_user_vectors(cls, user_id) -> UserVectors:
+        """Keeps a user's cached vectors warm, applying only what changed on disk since they were loaded."""
+        key = str(user_id)
+        with cls._lock:
+            shard = cls._shards.get(key)
+        refreshed = cls._refreshed(shard, VectorStore(user_id)) if shard is not None else None
+        if refreshed is not None:
+            with cls._lock:
+                cls._hits += 1
+            if refreshed is not shard:
+                cls._store(key, refreshed)
+            else:
+                with cls._lock:
+                    if key in cls._shards:
+                        cls._shards.move_to_end(key)
+            return refreshed
+        with cls._lock:
+            cls._misses += 1
+        return cls.load_user_vectors(user_id)
+
+    @classmethod
+    def prewarm(cls, user_id):
+        """Starts ensure_user_vectors in the background and returns its Future.
+
+        Pages call this instead of loading synchronously; retrieval waits on the Future only
+        when it actually needs the user's vectors. Under eventlet the pool's threads are green.
+        """
+        key = str(user_id)
+        with cls._lock:
+            future = cls._prewarming.get(key)
+            if future is not None:
+                return future
+            if cls._prewarm_executor is None:
+                cls._prewarm_executor = ThreadPoolExecutor(max_workers=cls._prewarm_workers,
+                                                           thread_name_prefix="vector-prewarm")
+            future = cls._prewarm_executor.submit(cls._prewarm, current_app._get_current_object(), user_id)
+            cls._prewarming[key] = future
+        future.add_done_callback(lambda _: cls._finish_prewarm(key, future))
+        return future
+
+    @classmethod
+    def _prewarm(cls, app, user_id) -> UserVectors:
+        with app.app_context():
+            return cls.ensure_user_vectors(user_id)
+
+    @classmethod
+    def _finish_prewarm(cls, key: str, future) -> None:
+        with cls._lock:
+            if cls._prewarming.get(key) is future:
+                del cls._prewarming[key]
+
+    @classmethod
+    def _await_prewarm(cls, key: str):
+        # A page may already have started loading this user; wait for it rather than loading twice
+        with cls._lock:
+            future = cls._prewarming.get(key)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None  # The caller loads synchronously and surfaces the error itself
+
+    @classmethod
+    def add_vectors(cls, user_id, ids: list, matrix: np.ndarray, document_ids: list) -> None:
+        """Persists newly embedded chunks and appends them to the cached shard, if any."""
+        if not len(ids):
+            return
+        ids = [str(chunk_id) for chunk_id in ids]
+        matrix = np.asarray(matrix, dtype=VectorStore.vector_dtype)
+        store = VectorStore(user_id)
+        segment, version = store.append(ids, document_ids, matrix)
+        key = str(user_id)
+        with cls._lock:
+            shard = cls._shards.get(key)
+            # Only extend a shard that saw every earlier write; otherwise the next ensure catches up
+            if shard is not None and shard.signature == version - 1:
+                document_ids = np.array([str(i) for i in document_ids], dtype=ID_DTYPE)
+                mapped, _, _ = store.open_segment(segment)
+                cls._store(key, shard.extended(mapped, ids, document_ids, segment, version))
+
+    @classmethod
+    def remove_ids(cls, user_id, ids: list) -> None:
+        """Tombstones chunks on disk and in the cached shard; compaction reclaims them later."""
+        if not len(ids):
+            return
+        version = VectorStore(user_id).remove(ids)
+        key = str(user_id)
         with cls._lock:
-            if cls._vectors.size == 0:
-                return []
+            shard = cls._shards.get(key)
+            if shard is not None and shard.signature == version - 1:
+                cls._store(key, shard.withdrawn(ids, version))
+
+    @classmethod
+    def get_user_vectors(cls, user_id) -> UserVectors:
+        """The user's vectors for a query, caught up with anything other processes appended or removed.
+
+        A cached shard costs one manifest read to check; a page may already be loading the
+        user in the background, in which case that load is awaited rather than repeated.
+        """
+        key = str(user_id)
+        with cls._lock:
+            cached = key in cls._shards
+        if not cached:
+            cls._await_prewarm(key)
+        return cls.ensure_user_vectors(user_id)
+
+    @staticmethod
+    def _scan(matrix: np.ndarray, rows, query_vector: np.ndarray, scale: np.ndarray = None) -> np.ndarray:
+        if matrix.dtype == np.float32 and scale is None:
+            if rows is None:
+                return matrix @ query_vector
+            # Subsets of whole documents are long runs of consecutive rows, scored as zero-copy slices
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            if len(rows) >= (len(breaks) + 1) * MIN_RUN_ROWS:
+                scores = np.empty(len(rows), dtype=np.float32)
+                for start, stop in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(rows)]])):
+                    scores[start:stop] = matrix[rows[start]:rows[stop - 1] + 1] @ query_vector
+                return scores
+            # Gathering a large subset costs more than scoring every row and picking the subset's scores
+            if len(rows) * SUBSET_GATHER_RATIO >= matrix.shape[0]:
+                return (matrix @ query_vector)[rows]
+            return matrix[rows] @ query_vector
+
+        # Upcast int8 / float16 rows block by block into a reused, cache-sized float32 buffer
+        count = matrix.shape[0] if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        buffer = np.empty((SCAN_BLOCK_ROWS, matrix.shape[1]), dtype=np.float32)
+        for start in range(0, count, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, count)
+            block = matrix[start:stop] if rows is None else matrix[rows[start:stop]]
+            upcast = buffer[: stop - start]
+            np.copyto(upcast, block, casting="unsafe")
+            scores[start:stop] = upcast @ query_vector
+        if scale is not None:
+            scores *= scale if rows is None else scale[rows]
+        return scores
+
+    @classmethod
+    def _route(cls, shard: UserVectors, rows, query_vector: np.ndarray):
+        """Narrows rows to the documents whose centroids best match the query.
+
+        Returns rows unchanged when there are few documents or no document clearly stands out.
+        """
+        documents, row_documents = shard.document_index()
+        counts = np.bincount(row_documents if rows is None else row_documents[rows], minlength=len(documents))
+        candidates = np.flatnonzero(counts)
+        if len(candidates) <= cls._routing_top_documents:
+            return rows
+        scores = shard.document_centroids()[candidates] @ normalize_rows(query_vector)
+        best = cls._top_k(scores, cls._routing_top_documents)
+        if scores[best[0]] - np.median(scores) < cls._routing_min_spread:
+            return rows
+        routed = np.zeros(len(documents), dtype=bool)
+        routed[candidates[best]] = True
+        if rows is None:
+            return np.flatnonzero(routed[row_documents])
+        return rows[routed[row_documents[rows]]]
+
+    @classmethod
+    def search(cls, user_id, query_vector: np.ndarray, top_k: int, subset_ids: list = None,
+               document_ids=None, selected_only: bool = False) -> list:
+        """Returns the top_k (chunk_id, score) pairs, optionally restricted to subset_ids, to the
+        chunks of document_ids, or to the documents the user has selected.
+
+        Large scans may first be routed to the documents whose centroids best match the query,
+        and very large ones narrowed by the user's ANN index, if either is configured.
+        Large scans then rank truncated and/or int8-quantised vectors, and rescore only
+        the best candidates exactly against the full-dimension embeddings.
+        """
+        cls._validate_query(query_vector)
 
-            subset_indices = [cls._ids.index(str(chunk_id)) for chunk_id in subset_ids if str(chunk_id) in cls._ids]
-            subset_vectors = cls._vectors[subset_indices]
+        shard = cls.get_user_vectors(user_id)
+        if shard.vectors.size == 0:
+            return []
 
-        # Calculate dot products using NumPy's vectorized operations
-        similarities = np.dot(subset_vectors, query_vector)
+        if selected_only:
+            rows = shard.rows_for_selection(*cls.selected_documents(user_id))
+        elif document_ids is not None:
+            rows = shard.rows_for_documents(document_ids)
+        else:
+            rows = shard.live_rows() if subset_ids is None else shard.rows_for(subset_ids)
+        scanned = len(shard.ids) if rows is None else len(rows)
+        if cls._routing_top_documents is not None and scanned > cls._routing_min_rows:
+            rows = cls._route(shard, rows, query_vector)
+            scanned = len(shard.ids) if rows is None else len(rows)
+        if shard.ann is not None and scanned > ANNIndex.min_rows:
+            probed = shard.ann.probe(query_vector, ANNIndex.nprobe)
+            if rows is not None:
+                probed = np.intersect1d(rows, probed, assume_unique=True)
+            if len(probed) >= top_k:  # Otherwise the selection is too narrow for the probed lists
+                rows = probed
+                scanned = len(rows)
+        # Quantised shards always rerank; a float32 coarse stage only pays off on large scans
+        if shard.scan is not None and (shard.scan_scale is not None or scanned > cls._two_stage_min_rows):
+            scan_scores = cls._scan(shard.scan, rows, shard.scan_query(query_vector), shard.scan_scale)
+            candidates = cls._top_k(scan_scores, top_k * cls._rerank_factor)
+            rows = candidates if rows is None else rows[candidates]
 
-        # Combine IDs and similarities, then sort by similarity score in descending order
-        ranked_similarities = sorted(zip([cls._ids[i] for i in subset_indices], similarities), key=lambda x: x[1],
-                                     reverse=True)
+        scores = cls._scan(shard.vectors, rows, query_vector)
+        best = cls._top_k(scores, top_k)
+        if rows is not None:
+            return [(shard.ids[rows[i]], float(scores[i])) for i in best]
+        return [(shard.ids[i], float(scores[i])) for i in best]
 
-        return [(chunk_id, rank + 1) for rank, (chunk_id, _) in enumerate(ranked_similarities)]
\ No newline at end of file
+    @classmethod
+    def diversifies(cls) -> bool:
+        return cls._mmr_lambda is not None or cls._dedupe_threshold is not None
+
+    @classmethod
+    def candidate_count(cls, top_k: int) -> int:
+        """How many ranked candidates to hand to diversify() for top_k results."""
+        return top_k * cls._diversity_factor if cls.diversifies() else top_k
+
+    @classmethod
+    def diversify(cls, user_id, chunk_ids: list, top_k: int) -> list:
+        """Picks top_k of the ranked chunk_ids, skipping near-duplicates and, with MMR, favouring variety.
+
+        MMR relevance comes from each candidate's position in the incoming ranking rather than
+        its dense score, so a hybrid ranking fused with BM25 keeps its order. Every pairwise
+        similarity between the candidates comes from a single matmul; the greedy selection then
+        only takes running maxima over that matrix.
+        """
+        if not cls.diversifies() or len(chunk_ids) <= 1:
+            return chunk_ids[:top_k]
+        shard = cls.get_user_vectors(user_id)
+        chunk_ids = [chunk_id for chunk_id in chunk_ids if chunk_id in shard.index]
+        candidates = normalize_rows(np.asarray(shard.vectors[shard.rows_for(chunk_ids)], dtype=np.float32))
+        similarity = candidates @ candidates.T
+
+        # Falls linearly from 1 for the best candidate towards 0, on the same scale as cosine redundancy
+        relevance = 1 - np.arange(len(chunk_ids), dtype=np.float32) / len(chunk_ids)
+        if cls._mmr_lambda is not None:
+            relevance *= cls._mmr_lambda
+        redundancy = np.zeros(len(chunk_ids), dtype=np.float32)  # Max similarity to anything already picked
+        available = np.ones(len(chunk_ids), dtype=bool)
+        picked = []
+        while len(picked) < top_k and available.any():
+            scores = relevance if not picked or cls._mmr_lambda is None \
+                else relevance - (1 - cls._mmr_lambda) * redundancy
+            pick = int(np.argmax(np.where(available, scores, -np.inf)))
+            picked.append(pick)
+            available[pick] = False
+            np.maximum(redundancy, similarity[pick], out=redundancy)
+            if cls._dedupe_threshold is not None:
+                available &= redundancy < cls._dedupe_threshold
+        return [chunk_ids[i] for i in picked]
+
+    @classmethod
+    def mips_naive(cls, user_id, query_vector: np.ndarray, subset_ids: list) -> list:
+        cls._validate_query(query_vector)
+
+        shard = cls.get_user_vectors(user_id)
+        if shard.vectors.size == 0:
+            return []
+
+        subset_indices = shard.rows_for(subset_ids)
+        similarities = cls._scan(shard.vectors, subset_indices, query_vector)
+
+        # Rank every subset chunk by similarity, best first
+        order = np.argsort(similarities)[::-1]
+        return [(shard.ids[subset_indices[i]], rank + 1) for rank, i in enumerate(order)]
+
+    @classmethod
+    def measure_recall(cls, user_id, query_vectors, top_k: int) -> float:
+        """Mean recall@top_k of search() against exact float32 mips_naive over all rows."""
+        shard = cls.get_user_vectors(user_id)
+        if not shard.ids:
+            return 1.0
+        recalls = []
+        for query_vector in query_vectors:
+            exact = {chunk_id for chunk_id, _ in cls.mips_naive(user_id, query_vector, shard.ids)[:top_k]}
+            found = {chunk_id for chunk_id, _ in cls.search(user_id, query_vector, top_k)}
+            recalls.append(len(exact & found) / len(exact))
+        return float(np.mean(recalls))
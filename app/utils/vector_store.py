@@ -0,0 +1,388 @@
+import fcntl
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.modules.user.user_util import get_user_vector_directory
+
+MANIFEST_FILE = "manifest.json"
+TOMBSTONE_FILE = "tombstones.npy"
+SELECTION_FILE = "selection.npy"  # Ids of the documents the user has selected for retrieval
+LOCK_FILE = ".lock"
+DERIVED_DIRECTORY = "derived"  # Arrays computed from the segments, shared by every process
+ID_DTYPE = "S36"  # Chunk and document ids are uuid4 strings
+COMPACTION_SEGMENT_THRESHOLD = 8  # Segments a user may accumulate before a compaction is scheduled
+COMPACTION_TOMBSTONE_RATIO = 0.25  # Fraction of removed rows that makes a compaction worthwhile
+COMPACTION_BLOCK_ROWS = 4096  # Rows copied at a time while compacting, ~48MB of 3072-dim float32
+
+
+class SegmentedVectors:
+    """Read-only row-wise concatenation of memory-mapped segments that never copies them.
+
+    Supports the access patterns of the scans: row slices, integer row arrays and boolean
+    masks (optionally with a column slice) return ndarrays of just those rows, and a matmul
+    with a query is computed segment by segment.
+    """
+
+    ndim = 2
+
+    def __init__(self, segments: list):
+        self.segments = segments
+        self.offsets = np.cumsum([0] + [len(segment) for segment in segments])
+        self.shape = (int(self.offsets[-1]), segments[0].shape[1])
+        self.dtype = segments[0].dtype
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def resident_nbytes(self) -> int:
+        # Only segments held in this process's memory; mapped ones live in the shared page cache
+        return sum(segment.nbytes for segment in self.segments if not isinstance(segment, np.memmap))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def appended(self, segment: np.ndarray) -> "SegmentedVectors":
+        return SegmentedVectors(self.segments + [segment])
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step != 1:
+                rows = np.arange(start, stop, step)
+            else:
+                parts = [
+                    segment[max(start - offset, 0):max(stop - offset, 0), columns]
+                    for segment, offset in zip(self.segments, self.offsets)
+                    if offset < stop and offset + len(segment) > start
+                ]
+                if len(parts) == 1:
+                    return parts[0]  # A view into the mapped segment
+                return np.concatenate(parts) if parts else self.segments[0][0:0, columns]
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+        if rows.ndim == 0:
+            segment = int(np.searchsorted(self.offsets, rows, side="right")) - 1
+            return self.segments[segment][int(rows) - self.offsets[segment], columns]
+        owners = np.searchsorted(self.offsets, rows, side="right") - 1
+        width = len(range(self.shape[1])[columns])
+        result = np.empty((len(rows), width), dtype=self.dtype)
+        for segment in np.unique(owners):
+            positions = np.flatnonzero(owners == segment)
+            result[positions] = self.segments[segment][rows[positions] - self.offsets[segment], columns]
+        return result
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        return np.concatenate([segment @ other for segment in self.segments])
+
+    def __array__(self, dtype=None):
+        return np.concatenate(self.segments).astype(dtype or self.dtype, copy=False)
+
+
+class VectorStore:
+    """Append-only on-disk embedding segments for one user, opened with np.memmap.
+
+    Each segment is a float32 or float16 matrix plus chunk-id and document-id sidecars. A small
+    manifest lists the live segments; it is only ever replaced atomically, so readers
+    in any process see either the old or the new set of segments. Removed chunks are
+    recorded as tombstones until a compaction rewrites the segments without them.
+    """
+
+    vector_dtype = np.float32  # float16 halves disk and page-cache use; scores are still computed in float32
+
+    def __init__(self, user_id):
+        self.user_id = str(user_id)
+        self.directory = get_user_vector_directory(user_id)
+
+    @classmethod
+    def configure(cls, config) -> None:
+        cls.vector_dtype = np.dtype(config.get("VECTOR_STORE_DTYPE", "float32"))
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    @contextmanager
+    def locked(self):
+        # Serialises writers across web workers and Celery processes
+        with open(self._path(LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(self._path(MANIFEST_FILE), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"version": 0, "backfilled": False, "segments": []}
+
+    def _write_manifest(self, manifest: dict) -> None:
+        temp_path = self._path(f".{MANIFEST_FILE}.{uuid.uuid4().hex}")
+        with open(temp_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, self._path(MANIFEST_FILE))
+
+    def version(self):
+        manifest = self.read_manifest()
+        return manifest["version"] if manifest["backfilled"] else None
+
+    def is_backfilled(self) -> bool:
+        return self.read_manifest()["backfilled"]
+
+    def segment_count(self) -> int:
+        return len(self.read_manifest()["segments"])
+
+    def needs_compaction(self) -> bool:
+        manifest = self.read_manifest()
+        if len(manifest["segments"]) >= COMPACTION_SEGMENT_THRESHOLD:
+            return True
+        return manifest.get("tombstones", 0) > manifest.get("rows", 0) * COMPACTION_TOMBSTONE_RATIO
+
+    def tombstones(self) -> np.ndarray:
+        try:
+            return np.load(self._path(TOMBSTONE_FILE))
+        except FileNotFoundError:
+            return np.empty(0, dtype=ID_DTYPE)
+
+    def selection(self) -> tuple:
+        """Returns (signature, selected document ids), or (None, None) if never saved.
+
+        The signature changes whenever the selection is rewritten, so readers can tell
+        with a single stat() whether their cached copy is current.
+        """
+        try:
+            status = os.stat(self._path(SELECTION_FILE))
+            return (status.st_ino, status.st_mtime_ns), np.load(self._path(SELECTION_FILE))
+        except FileNotFoundError:
+            return None, None
+
+    def selection_signature(self):
+        try:
+            status = os.stat(self._path(SELECTION_FILE))
+            return status.st_ino, status.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def save_selection(self, document_ids) -> None:
+        self._save_array(SELECTION_FILE, np.array([str(i) for i in document_ids], dtype=ID_DTYPE))
+
+    def _save_array(self, filename: str, array: np.ndarray, directory: str = None) -> None:
+        directory = directory or self.directory
+        temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as file:
+            np.save(file, array)
+        os.replace(temp_path, os.path.join(directory, filename))
+
+    def _write_segment(self, chunk_ids, document_ids, vectors: np.ndarray) -> str:
+        name = uuid.uuid4().hex
+        self._save_array(f"{name}.vectors.npy", np.ascontiguousarray(vectors, dtype=self.vector_dtype))
+        self._save_array(f"{name}.ids.npy", np.array([str(i) for i in chunk_ids], dtype=ID_DTYPE))
+        self._save_array(f"{name}.docs.npy", np.array([str(i) for i in document_ids], dtype=ID_DTYPE))
+        return name
+
+    def _copy_segment(self, chunk_ids, document_ids, vectors, rows: np.ndarray) -> str:
+        """Writes vectors[rows] as a new segment through a memmap, a block of rows at a time,
+        so compacting a large user never holds their vectors in memory."""
+        name = uuid.uuid4().hex
+        temp_path = self._path(f".{name}.vectors.npy.{uuid.uuid4().hex}")
+        try:
+            copied = np.lib.format.open_memmap(temp_path, mode="w+", dtype=self.vector_dtype,
+                                               shape=(len(rows), vectors.shape[1]))
+            for start in range(0, len(rows), COMPACTION_BLOCK_ROWS):
+                block = rows[start:start + COMPACTION_BLOCK_ROWS]
+                copied[start:start + len(block)] = vectors[block]
+            copied.flush()
+            del copied
+            os.replace(temp_path, self._path(f"{name}.vectors.npy"))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._save_array(f"{name}.ids.npy", chunk_ids[rows].astype(ID_DTYPE))
+        self._save_array(f"{name}.docs.npy", document_ids[rows].astype(ID_DTYPE))
+        return name
+
+    def _remove_segment(self, name: str) -> None:
+        # Processes that still have the segment mapped keep reading the unlinked inode
+        for suffix in ("vectors", "ids", "docs"):
+            try:
+                os.remove(self._path(f"{name}.{suffix}.npy"))
+            except FileNotFoundError:
+                pass
+
+    def append(self, chunk_ids, document_ids, vectors: np.ndarray) -> tuple:
+        """Writes a new segment and returns (segment name, new manifest version)."""
+        with self.locked():
+            name = self._write_segment(chunk_ids, document_ids, vectors)
+            manifest = self.read_manifest()
+            manifest["segments"].append(name)
+            manifest["rows"] = manifest.get("rows", 0) + len(chunk_ids)
+            manifest["version"] += 1
+            self._write_manifest(manifest)
+            return name, manifest["version"]
+
+    def remove(self, chunk_ids) -> int:
+        """Tombstones chunks so loaders skip them, and returns the new manifest version."""
+        with self.locked():
+            tombstones = np.union1d(self.tombstones(), np.array([str(i) for i in chunk_ids], dtype=ID_DTYPE))
+            self._save_array(TOMBSTONE_FILE, tombstones.astype(ID_DTYPE))
+            manifest = self.read_manifest()
+            manifest["tombstones"] = len(tombstones)
+            manifest["version"] += 1
+            self._write_manifest(manifest)
+            return manifest["version"]
+
+    def backfill(self, fetch_rows) -> None:
+        """Seeds the store from the database for users whose vectors predate it.
+
+        fetch_rows runs under the store lock so that no concurrent append can be lost, and
+        must return (chunk_ids, document_ids, vectors) for all of the user's embeddings.
+        """
+        with self.locked():
+            if self.read_manifest()["backfilled"]:
+                return
+            self._replace_locked(*fetch_rows())
+
+    def _replace_locked(self, chunk_ids, document_ids, vectors: np.ndarray) -> None:
+        segment = self._write_segment(chunk_ids, document_ids, vectors) if len(chunk_ids) else None
+        self._publish_locked(segment, len(chunk_ids))
+
+    def _publish_locked(self, segment, rows: int) -> None:
+        """Makes segment (or no segment) the whole store, clearing tombstones and removing the old segments."""
+        manifest = self.read_manifest()
+        old_segments = manifest["segments"]
+        manifest["segments"] = [segment] if segment is not None else []
+        manifest["rows"] = rows
+        manifest["tombstones"] = 0
+        manifest["version"] += 1
+        manifest["backfilled"] = True
+        self._save_array(TOMBSTONE_FILE, np.empty(0, dtype=ID_DTYPE))
+        self._write_manifest(manifest)
+        for name in old_segments:
+            self._remove_segment(name)
+
+    def open_segment(self, name: str):
+        vectors = np.load(self._path(f"{name}.vectors.npy"), mmap_mode="r")
+        chunk_ids = np.load(self._path(f"{name}.ids.npy"))
+        document_ids = np.load(self._path(f"{name}.docs.npy"))
+        return vectors, chunk_ids, document_ids
+
+    def _open_segments(self, open_segment) -> tuple:
+        for attempt in range(3):
+            manifest = self.read_manifest()
+            try:
+                return [open_segment(name) for name in manifest["segments"]], manifest
+            except FileNotFoundError:
+                # A compaction replaced the segments between reading the manifest and opening them
+                if attempt == 2:
+                    raise
+
+    def load(self):
+        """Returns (vectors, chunk_ids, document_ids, manifest) for every stored row.
+
+        A single segment is returned as a read-only memmap and several as SegmentedVectors
+        over their memmaps, so no process holds a private copy of the vectors. Tombstoned rows
+        are included; callers mask them with tombstones(). A chunk written twice, by an append
+        that raced a backfill, appears twice and only its last row is current.
+        """
+        segments, manifest = self._open_segments(self.open_segment)
+        if not segments:
+            empty_ids = np.empty(0, dtype=ID_DTYPE)
+            return np.empty((0, 0), dtype=np.float32), empty_ids, empty_ids, manifest
+        if len(segments) == 1:
+            vectors, chunk_ids, document_ids = segments[0]
+            return vectors, chunk_ids, document_ids, manifest
+        vectors = SegmentedVectors([segment[0] for segment in segments])
+        chunk_ids = np.concatenate([segment[1] for segment in segments])
+        document_ids = np.concatenate([segment[2] for segment in segments])
+        return vectors, chunk_ids, document_ids, manifest
+
+    def chunk_ids(self) -> np.ndarray:
+        """Ids of every stored row, read from the id sidecars without opening the vectors."""
+        segments, _ = self._open_segments(lambda name: np.load(self._path(f"{name}.ids.npy")))
+        return np.concatenate(segments) if segments else np.empty(0, dtype=ID_DTYPE)
+
+    def compact(self, live_document_ids) -> None:
+        """Merges all segments into one, dropping tombstoned rows and deleted documents."""
+        live_document_ids = np.array([str(i) for i in live_document_ids], dtype=ID_DTYPE)
+        with self.locked():
+            if not self.read_manifest()["backfilled"]:
+                return  # The next load will rebuild the store from the database anyway
+            vectors, chunk_ids, document_ids, _ = self.load()
+            _, last_rows = np.unique(chunk_ids[::-1], return_index=True)
+            current = np.zeros(len(chunk_ids), dtype=bool)
+            current[len(chunk_ids) - 1 - last_rows] = True  # Only the last copy of a chunk written twice
+            keep = np.flatnonzero(current & np.isin(document_ids, live_document_ids)
+                                  & ~np.isin(chunk_ids, self.tombstones()))
+            # Group each document's rows so document-filtered scans read contiguous slices
+            keep = keep[np.argsort(document_ids[keep], kind="stable")]
+            segment = self._copy_segment(chunk_ids, document_ids, vectors, keep) if len(keep) else None
+            self._publish_locked(segment, len(keep))
+
+    def _attach_derived(self, key: str, version: int):
+        directory = os.path.join(self.directory, DERIVED_DIRECTORY)
+        try:
+            with open(os.path.join(directory, f"{key}.json"), "r") as file:
+                published = json.load(file)
+            if published["version"] != version:
+                return None
+            return {
+                name: np.load(os.path.join(directory, filename), mmap_mode="r")
+                for name, filename in published["arrays"].items()
+            }
+        except FileNotFoundError:
+            return None
+
+    def shared_arrays(self, key: str, version: int, build) -> dict:
+        """Returns arrays derived from store version `version`, built once and shared by all processes.
+
+        The first process to ask builds them under the store lock and publishes them as .npy
+        files beside a small {key}.json version record; every other worker attaches to the same
+        files read-only through np.memmap instead of holding its own copy. build must return a
+        dict of name -> array.
+        """
+        arrays = self._attach_derived(key, version)
+        if arrays is not None:
+            return arrays
+        with self.locked():
+            arrays = self._attach_derived(key, version)
+            if arrays is not None:
+                return arrays
+            built = build()
+            if self.read_manifest()["version"] != version:
+                return built  # The store moved on while building; publishing would be stale
+
+            directory = os.path.join(self.directory, DERIVED_DIRECTORY)
+            os.makedirs(directory, exist_ok=True)
+            record_path = os.path.join(directory, f"{key}.json")
+            try:
+                with open(record_path, "r") as file:
+                    stale_files = list(json.load(file)["arrays"].values())
+            except FileNotFoundError:
+                stale_files = []
+
+            published = {"version": version, "arrays": {}}
+            for name, array in built.items():
+                filename = f"{key}.{version}.{name}.npy"
+                self._save_array(filename, array, directory)
+                published["arrays"][name] = filename
+            temp_path = os.path.join(directory, f".{key}.json.{uuid.uuid4().hex}")
+            with open(temp_path, "w") as file:
+                json.dump(published, file)
+            os.replace(temp_path, record_path)
+            for filename in stale_files:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    pass
+        return self._attach_derived(key, version) or built
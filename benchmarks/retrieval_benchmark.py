@@ -0,0 +1,246 @@
+"""Retrieval benchmark: synthetic users in SQLite, timed against the real retrieval code.
+
+For each corpus size a user is created with documents, DocumentChunk rows and 3072-dim
+DocumentEmbedding rows, then VectorCache.load_user_vectors, VectorCache.search, mips_naive
+and both find_relevant_sections variants are timed. Results are written as JSON so runs can
+be diffed across commits:
+
+    python benchmarks/retrieval_benchmark.py --sizes 1000,10000,100000 --distribution clustered
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SQL_PASSWORD", "")  # config.py url-encodes it at import time
+
+from flask import Flask  # noqa: E402
+
+from app import db  # noqa: E402
+from app.modules.user import user_util  # noqa: E402
+from config import Config  # noqa: E402
+
+CHUNKS_PER_DOCUMENT = 200
+INSERT_BATCH_ROWS = 2000
+VOCABULARY_SIZE = 5000
+WORDS_PER_CHUNK = 120
+CONTEXT_MODEL = "gpt-3.5-turbo"
+
+
+def percentiles(samples: list) -> dict:
+    milliseconds = np.array(samples) * 1000
+    return {
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p95_ms": float(np.percentile(milliseconds, 95)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "mean_ms": float(milliseconds.mean()),
+    }
+
+
+def rss_mb() -> dict:
+    with open("/proc/self/statm", "r") as file:
+        resident_pages = int(file.read().split()[1])
+    return {
+        "rss_mb": resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_vectors(rng, rows: int, dims: int, distribution: str, centers=None) -> np.ndarray:
+    if distribution == "clustered":
+        vectors = centers[rng.integers(len(centers), size=rows)] + 0.3 * rng.standard_normal((rows, dims))
+    else:
+        vectors = rng.standard_normal((rows, dims))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_app(workdir: str, database_url: str = None) -> Flask:
+    app = Flask("retrieval_benchmark")
+    app.config.from_object(Config)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+    db.init_app(app)
+    user_util.USER_DIRECTORY = workdir  # Keep vector stores out of app/user_files
+    return app
+
+
+def seed_user(rng, size: int, dims: int, distribution: str) -> str:
+    from app.models.chat_models import ChatPreferences
+    from app.models.embedding_models import Document, DocumentChunk, DocumentEmbedding
+    from app.models.user_models import User
+
+    user_id = str(uuid.uuid4())
+    db.session.add(User(id=user_id, username=user_id[:20], email=f"{user_id}@benchmark.local", password_hash="x"))
+    db.session.add(ChatPreferences(user_id=user_id, model=CONTEXT_MODEL, top_k=5, threshold=0.0))
+    db.session.commit()
+
+    centers = rng.standard_normal((max(1, int(np.sqrt(size))), dims)) if distribution == "clustered" else None
+    vocabulary = np.array([f"term{i}" for i in range(VOCABULARY_SIZE)])
+    for start in range(0, size, INSERT_BATCH_ROWS):
+        rows = min(INSERT_BATCH_ROWS, size - start)
+        vectors = make_vectors(rng, rows, dims, distribution, centers)
+        documents, chunks, embeddings = [], [], []
+        for offset in range(rows):
+            index = start + offset
+            if index % CHUNKS_PER_DOCUMENT == 0:
+                document_id = str(uuid.uuid4())
+                documents.append({"id": document_id, "user_id": user_id, "title": f"Document {index}",
+                                  "total_tokens": 0, "selected": True, "delete": False})
+            chunk_id = str(uuid.uuid4())
+            words = vocabulary[rng.zipf(1.3, WORDS_PER_CHUNK) % VOCABULARY_SIZE]
+            chunks.append({"id": chunk_id, "document_id": document_id, "chunk_index": index % CHUNKS_PER_DOCUMENT,
+                           "content": " ".join(words), "tokens": WORDS_PER_CHUNK, "pages": "1"})
+            embeddings.append({"id": str(uuid.uuid4()), "chunk_id": chunk_id, "user_id": user_id,
+                               "embedding": vectors[offset].tobytes(), "model": "text-embedding-3-large"})
+        if documents:
+            db.session.execute(Document.__table__.insert(), documents)
+        db.session.execute(DocumentChunk.__table__.insert(), chunks)
+        db.session.execute(DocumentEmbedding.__table__.insert(), embeddings)
+        db.session.commit()
+    return user_id
+
+
+def time_calls(function, queries) -> list:
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        function(query)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def benchmark_size(rng, size: int, args) -> dict:
+    from app.models.chat_models import ChatPreferences
+    from app.modules.cwd import cwd_util
+    from app.modules.embedding import embedding_util
+    from app.utils.vector_cache import VectorCache
+
+    seed_started = time.perf_counter()
+    user_id = seed_user(rng, size, args.dims, args.distribution)
+    seed_seconds = time.perf_counter() - seed_started
+
+    VectorCache.clear_cache()
+    started = time.perf_counter()
+    shard = VectorCache.load_user_vectors(user_id)  # First load backfills the store from SQLite
+    backfill_seconds = time.perf_counter() - started
+    VectorCache.clear_cache()
+    started = time.perf_counter()
+    shard = VectorCache.load_user_vectors(user_id)
+    load_seconds = time.perf_counter() - started
+
+    # Queries near stored rows, so the exact neighbours are meaningful
+    sample = rng.choice(len(shard.ids), size=args.queries, replace=len(shard.ids) < args.queries)
+    queries = np.asarray(shard.vectors[sample], dtype=np.float32)
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(args.dims)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    query_texts = [f"term{i} term{i * 7 % VOCABULARY_SIZE}" for i in range(args.queries)]
+    preferences = ChatPreferences.query.filter_by(user_id=user_id).one()
+    preferences.top_k = args.top_k
+
+    results = {
+        "size": size,
+        "distribution": args.distribution,
+        "dims": args.dims,
+        "top_k": args.top_k,
+        "seed_seconds": seed_seconds,
+        "backfill_seconds": backfill_seconds,
+        "load_seconds": load_seconds,
+        "latency": {
+            "search": percentiles(time_calls(lambda q: VectorCache.search(user_id, q, args.top_k), queries)),
+            "mips_naive": percentiles(time_calls(lambda q: VectorCache.mips_naive(user_id, q, shard.ids), queries)),
+            "find_relevant_sections": percentiles(time_calls(
+                lambda i: embedding_util.find_relevant_sections(
+                    user_id, queries[i], preferences, query_text=query_texts[i]),
+                range(args.queries))),
+            "cwd_find_relevant_sections": percentiles(time_calls(
+                lambda i: cwd_util.find_relevant_sections(
+                    user_id, queries[i], user_preferences=preferences, query_text=query_texts[i]),
+                range(args.queries))),
+        },
+        "recall_at_k": VectorCache.measure_recall(user_id, queries, args.top_k),
+        "cache": VectorCache.stats(),
+    }
+    results.update(rss_mb())
+    VectorCache.clear_cache()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated chunk counts, one user each")
+    parser.add_argument("--dims", type=int, default=3072)
+    parser.add_argument("--distribution", choices=("random", "clustered"), default="clustered")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file; defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--keep", action="store_true", help="Keep the SQLite database and vector stores")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    app = make_app(workdir)
+    rng = np.random.default_rng(args.seed)
+    try:
+        with app.app_context():
+            from app.models import (audio_models, chat_models, embedding_models, image_models,  # noqa: F401
+                                    task_models, user_models)
+            from app.models.embedding_models import ModelContextWindow
+            from app.utils.ann_index import ANNIndex
+            from app.utils.bm25_index import BM25Index
+            from app.utils.vector_cache import VectorCache
+            from app.utils.vector_store import VectorStore
+
+            VectorCache.configure(app.config)
+            VectorStore.configure(app.config)
+            ANNIndex.configure(app.config)
+            BM25Index.configure(app.config)
+            db.create_all()
+            db.session.add(ModelContextWindow(model_name=CONTEXT_MODEL, context_window_size=16385))
+            db.session.commit()
+
+            report = {
+                "commit": git_commit(),
+                "created_at": datetime.utcnow().isoformat(),
+                "settings": {key: app.config.get(key) for key in sorted(app.config)
+                             if key.startswith(("VECTOR_", "HYBRID_", "RETRIEVAL_"))},
+                "results": [],
+            }
+            for size in [int(size) for size in args.sizes.split(",")]:
+                result = benchmark_size(rng, size, args)
+                report["results"].append(result)
+                print(f"{size:>8} rows  load {result['load_seconds']:.3f}s  "
+                      f"search p50 {result['latency']['search']['p50_ms']:.2f}ms "
+                      f"p99 {result['latency']['search']['p99_ms']:.2f}ms  "
+                      f"recall@{args.top_k} {result['recall_at_k']:.3f}  rss {result['rss_mb']:.0f}MB")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(os.path.dirname(__file__), "results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,18 @@ class Config(object):
             'task': 'app.tasks.celerybeat_task.cleanup_transcription',  # Use the correct path to your task function
             'schedule': crontab(minute="4", hour='*/3'),  # At minute 0 past hour 0 and 12.
         },
+        'periodic_vector_compaction': {
+            'task': 'app.tasks.celerybeat_task.compact_vector_stores',
+            'schedule': crontab(minute="5", hour='*/3'),
+        },
+        'periodic_query_embedding_check': {
+            'task': 'app.tasks.celerybeat_task.cleanup_query_embeddings',
+            'schedule': crontab(minute="6", hour='*/3'),
+        },
+        'periodic_content_hash_backfill': {
+            'task': 'app.tasks.celerybeat_task.backfill_content_hashes',
+            'schedule': crontab(minute="*/15"),  # A no-op once every chunk has a hash
+        },
     }
 
     SESSION_COOKIE_HTTPONLY = True
@@ -85,6 +97,45 @@ class Config(object):
 
     DEFAULT_USER_PASSWORD = os.getenv("DEFAULT_USER_PASSWORD")
 
+    VECTOR_CACHE_MAX_BYTES = int(os.getenv("VECTOR_CACHE_MAX_BYTES", 512 * 1024 * 1024))  # Per worker process
+    # e.g. 256 for a two-stage Matryoshka scan above VECTOR_CACHE_TWO_STAGE_MIN_ROWS; unset scans full vectors
+    # unless the user's tier sets embed_dimensions. Recall@5 was about 0.77 at 12k rows with a rerank factor
+    # of 10, so check VectorCache.measure_recall (or the retrieval benchmark) before turning it on
+    VECTOR_CACHE_COARSE_DIMS = os.getenv("VECTOR_CACHE_COARSE_DIMS")
+    VECTOR_CACHE_TWO_STAGE_MIN_ROWS = 10000
+    VECTOR_CACHE_RERANK_FACTOR = 10
+    VECTOR_CACHE_QUANTIZATION = os.getenv("VECTOR_CACHE_QUANTIZATION")  # "int8" to scan quantised vectors
+    VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float32")  # or "float16"
+    VECTOR_ANN_INDEX = os.getenv("VECTOR_ANN_INDEX")  # "ivf" to build per-user approximate indexes
+    VECTOR_ANN_NPROBE = int(os.getenv("VECTOR_ANN_NPROBE", 8))  # Raise for recall, lower for latency
+    VECTOR_ANN_MIN_ROWS = 50000
+    VECTOR_ROUTING_TOP_DOCUMENTS = os.getenv("VECTOR_ROUTING_TOP_DOCUMENTS")  # e.g. 8; unset scans every document
+    VECTOR_ROUTING_MIN_ROWS = 10000
+    VECTOR_ROUTING_MIN_SPREAD = 0.05  # Fall back to a full scan when no document's centroid stands out
+    VECTOR_CACHE_PREWARM_WORKERS = 2  # Background loads started on login, page views and socket connects
+
+    HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"  # BM25 + dense fusion
+    HYBRID_RRF_K = 60
+    HYBRID_CANDIDATE_FACTOR = 4  # Candidates taken from each ranker per requested section
+    BM25_CACHE_MAX_USERS = 64  # Merged keyword indexes kept per worker process
+    RETRIEVAL_MMR_LAMBDA = os.getenv("RETRIEVAL_MMR_LAMBDA")  # e.g. 0.7; unset disables MMR diversification
+    RETRIEVAL_DEDUPE_THRESHOLD = os.getenv("RETRIEVAL_DEDUPE_THRESHOLD")  # e.g. 0.95; unset keeps near-duplicates
+    RETRIEVAL_DIVERSITY_FACTOR = 4  # Candidates considered per section when diversifying
+
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024))  # Per worker process
+    QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 3600))  # Seconds
+    QUERY_EMBEDDING_CACHE_DIR = os.getenv("QUERY_EMBEDDING_CACHE_DIR")  # Shared spill directory; unset keeps it in memory
+
+    TEXT_SPLITTER_TOKEN_OFFSETS = os.getenv("TEXT_SPLITTER_TOKEN_OFFSETS", "true").lower() == "true"  # Encode each page once
+    PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 64))  # Smaller PDFs are extracted inline
+    PDF_EXTRACTION_WORKERS = os.getenv("PDF_EXTRACTION_WORKERS")  # Spawned processes per Celery worker; unset sizes by CPU, 1 disables
+    GPT_PREPROCESS_WORKERS = int(os.getenv("GPT_PREPROCESS_WORKERS", 8))  # Preprocessing requests in flight per Celery worker
+
+    RATE_LIMIT_DEFAULT_RPM = int(os.getenv("RATE_LIMIT_DEFAULT_RPM", 500))  # Per API key until response headers report the real limits
+    RATE_LIMIT_DEFAULT_TPM = int(os.getenv("RATE_LIMIT_DEFAULT_TPM", 200000))
+    RATE_LIMIT_INTERACTIVE_RESERVE = float(os.getenv("RATE_LIMIT_INTERACTIVE_RESERVE", 0.2))  # Headroom background jobs leave for chat
+    RATE_LIMIT_MAX_CLIENTS = 32  # Cached OpenAI http clients per process; evicted ones have their connections closed
+
     @classmethod
     def init_app(cls, app):
         cloudinary.config(cloud_name=cls.CLOUD_NAME, api_key=cls.CLOUD_API_KEY, api_secret=cls.CLOUD_SECRET)
@@ -0,0 +1,29 @@
+"""added embedding task attempts
+
+Revision ID: b7d2e4f6a813
+Revises: e5a7c3d91f02
+Create Date: 2024-04-25 10:03:17.226941
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f6a813'
+down_revision = 'e5a7c3d91f02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.alter_column('attempts', existing_type=sa.Integer(), server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.drop_column('attempts')
@@ -0,0 +1,39 @@
+"""added embedding checkpoints
+
+Revision ID: e5a7c3d91f02
+Revises: 9d3f6b2e8a41
+Create Date: 2024-04-24 18:12:40.508127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c3d91f02'
+down_revision = '9d3f6b2e8a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows that already exist are finished, so they are backfilled as embedded / complete
+    with op.batch_alter_table('document_chunks', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('embedded', sa.Boolean(), nullable=False, server_default=sa.true()))
+
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('stage', sa.String(length=20), nullable=False, server_default='complete'))
+
+    with op.batch_alter_table('document_chunks', schema=None) as batch_op:
+        batch_op.alter_column('embedded', existing_type=sa.Boolean(), server_default=None)
+
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.alter_column('stage', existing_type=sa.String(length=20), server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('embedding_task', schema=None) as batch_op:
+        batch_op.drop_column('stage')
+
+    with op.batch_alter_table('document_chunks', schema=None) as batch_op:
+        batch_op.drop_column('embedded')